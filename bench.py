@@ -0,0 +1,147 @@
+# bench.py - قياس أداء الشاشات الجاهزة ومحرك XO مقابل التنفيذ السابق
+# التشغيل: python bench.py [screens] [xo]
+
+import random
+import sys
+import time
+import tracemalloc
+from itertools import cycle
+
+from bot import (
+    MAIN_MENU_ROWS, ADMIN_MENU_ROW, GAMES_MENU_ROWS, Keyboards, Screens, XOEngine,
+    build_keyboard, xo_rows, xo_engine, adb, db,
+)
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def measure(func, iterations):
+    # الزمن لكل نداء، ثم الذاكرة وعدد الكتل المحجوزة لكل نداء مع إبقاء النتائج حية
+    func()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - started
+    kept = [None] * iterations
+    tracemalloc.start()
+    for i in range(iterations):
+        kept[i] = func()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = snapshot.statistics('filename')
+    size = sum(stat.size for stat in stats)
+    blocks = sum(stat.count for stat in stats)
+    del kept
+    return elapsed / iterations * 1e6, size / iterations, blocks / iterations
+
+def print_comparison(name, before, after):
+    print(f"{name:<14} {before[0]:8.2f} µs {before[1]:8.0f} B {before[2]:6.1f} blk  ->  "
+          f"{after[0]:8.2f} µs {after[1]:8.0f} B {after[2]:6.1f} blk")
+
+@benchmark("screens")
+def bench_screens(iterations):
+    cases = {
+        'main_menu': (lambda: build_keyboard(MAIN_MENU_ROWS + (ADMIN_MENU_ROW,)), lambda: Keyboards.main_menu(True)),
+        'games_menu': (lambda: build_keyboard(GAMES_MENU_ROWS), lambda: Keyboards.GAMES),
+        'xo_grid': (lambda: build_keyboard(xo_rows('heuristic')), lambda: Keyboards.XO['heuristic']),
+        'back_button': (lambda: build_keyboard(((('🔙 رجوع', 'back_main'),),)), lambda: Keyboards.BACK_MAIN),
+        'welcome': (
+            lambda: f"✨ أهلاً بك {'Ahmed'} ✨\n\n🎁 رصيدك: {1500} نقطة\n📊 مستواك: {16}\n\nاختر من القائمة 👇",
+            lambda: Screens.WELCOME.render(name='Ahmed', points=1500, level=16)
+        ),
+    }
+    print(f"الشاشات ({iterations} نداء): قبل (بناء كل مرة) -> بعد (مبنية مسبقاً)")
+    for name, (rebuilt, cached) in cases.items():
+        print_comparison(name, measure(rebuilt, iterations), measure(cached, iterations))
+
+@benchmark("xo")
+def bench_xo(iterations):
+    # التنفيذ السابق (قوائم + بحث جشع) كمرجع للمقارنة
+    def check_winner(board):
+        lines = [
+            [0,1,2], [3,4,5], [6,7,8],
+            [0,3,6], [1,4,7], [2,5,8],
+            [0,4,8], [2,4,6]
+        ]
+        for line in lines:
+            if board[line[0]] == board[line[1]] == board[line[2]] != ' ':
+                return board[line[0]]
+        if ' ' not in board:
+            return 'draw'
+        return None
+
+    def get_computer_move(board):
+        for i in range(9):
+            if board[i] == ' ':
+                board[i] = 'O'
+                if check_winner(board) == 'O':
+                    board[i] = ' '
+                    return i
+                board[i] = ' '
+        for i in range(9):
+            if board[i] == ' ':
+                board[i] = 'X'
+                if check_winner(board) == 'X':
+                    board[i] = ' '
+                    return i
+                board[i] = ' '
+        if board[4] == ' ':
+            return 4
+        corners = [0,2,6,8]
+        random.shuffle(corners)
+        for c in corners:
+            if board[c] == ' ':
+                return c
+        available = [i for i in range(9) if board[i] == ' ']
+        return random.choice(available) if available else None
+    
+    positions = []
+    while len(positions) < 200:
+        # عدد فردي من الحركات: الدور على O
+        board = [' '] * 9
+        for turn in range(random.randrange(1, 8, 2)):
+            board[random.choice([i for i in range(9) if board[i] == ' '])] = 'XO'[turn % 2]
+        if not check_winner(board):
+            positions.append(board)
+    next_board = cycle(positions).__next__
+    next_pair = cycle([XOEngine.encode(board) for board in positions]).__next__
+    
+    def legacy_move():
+        board = next_board()
+        move = get_computer_move(board)
+        board[move] = 'O'
+        result = check_winner(board)
+        board[move] = ' '
+        return result
+    
+    def engine_move(level):
+        def run():
+            x, o = next_pair()
+            return xo_engine.outcome(x, o | 1 << xo_engine.move(o, x, level))
+        return run
+    
+    started = time.perf_counter()
+    XOEngine()
+    print(f"XO ({iterations} حركة): جدول {len(xo_engine.table)} موقع، بناؤه {(time.perf_counter() - started) * 1000:.1f} ms")
+    before = measure(legacy_move, iterations)
+    for level in XOEngine.LEVELS:
+        print_comparison(level, before, measure(engine_move(level), iterations))
+
+def run_benchmarks(names, iterations=5000):
+    try:
+        for name in names or BENCHMARKS:
+            if name not in BENCHMARKS:
+                print(f"❌ لا يوجد قياس باسم {name} (المتاح: {', '.join(BENCHMARKS)})")
+                continue
+            BENCHMARKS[name](iterations)
+    finally:
+        adb.shutdown()
+        db.close()
+
+if __name__ == '__main__':
+    run_benchmarks(sys.argv[1:])
@@ -12,28 +12,111 @@ import math
 import re
 import string
 import secrets
+import signal
+import queue
+import threading
+import heapq
+import difflib
 from datetime import datetime, timedelta, date
-from collections import defaultdict
+from collections import defaultdict, deque, Counter, OrderedDict
+from bisect import bisect_left, insort
 from enum import Enum
 from typing import Dict, List, Tuple, Optional, Any, Union
 from contextlib import contextmanager
-from functools import wraps
+from functools import wraps, partial
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import aiohttp
+import numpy as np
+from aiohttp import web
+try:
+    from googletrans import Translator as GoogleTranslator
+    from googletrans.constants import LANGUAGES as GOOGLE_LANGUAGES
+except ImportError:
+    GoogleTranslator = None
+    GOOGLE_LANGUAGES = {}
+try:
+    from langdetect import detect_langs as detect_language, DetectorFactory, LangDetectException
+    DetectorFactory.seed = 0
+except ImportError:
+    detect_language = None
+    LangDetectException = ValueError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters, ContextTypes
+    ConversationHandler, TypeHandler, ApplicationHandlerStop, BaseRateLimiter,
+    BasePersistence, PersistenceInput, BaseUpdateProcessor, filters, ContextTypes
 )
 from telegram.constants import ParseMode
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 
 # ==================== الإعدادات الأساسية ====================
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8755132828:AAFQzrbEXq-w-ZfjCMNIHD7H4mOzHV0QFcw")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32])
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8080"))
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
 ADMIN_IDS = [int(id) for id in os.environ.get("ADMIN_IDS", "6918240643").split(",")]
 DATA_DIR = '/data/' if os.path.exists('/data/') else './'
 DATABASE_NAME = os.path.join(DATA_DIR, 'bot.db')
 os.makedirs(DATA_DIR, exist_ok=True)
+QUIZ_FILE = os.environ.get("QUIZ_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quiz_questions.json'))
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))
+DB_POOL_WAIT_WARN = float(os.environ.get("DB_POOL_WAIT_WARN", "0.05"))
+DB_PROFILE = os.environ.get("DB_PROFILE", "0").lower() in ("1", "true", "yes")
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "50"))
+DB_PROFILE_SAMPLES = int(os.environ.get("DB_PROFILE_SAMPLES", "512"))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "30"))
+ACTIVITY_FLUSH_MAX = int(os.environ.get("ACTIVITY_FLUSH_MAX", "500"))
+STATS_CACHE_TTL = float(os.environ.get("STATS_CACHE_TTL", "10"))
+LEDGER_FLUSH_INTERVAL = float(os.environ.get("LEDGER_FLUSH_INTERVAL", "5"))
+LEDGER_FLUSH_MAX = int(os.environ.get("LEDGER_FLUSH_MAX", "200"))
+FLOOD_RATES = os.environ.get("FLOOD_RATES", "game=0.5/4,callback=2/8,message=1/5,command=0.5/4")
+FLOOD_IDLE_TTL = float(os.environ.get("FLOOD_IDLE_TTL", "300"))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_DRAIN_TIMEOUT = float(os.environ.get("OUTBOUND_DRAIN_TIMEOUT", "5"))
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "30"))
+PERSISTENCE_IDLE_TTL = float(os.environ.get("PERSISTENCE_IDLE_TTL", "3600"))
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", "100"))
+REMINDER_HORIZON = float(os.environ.get("REMINDER_HORIZON", "3600"))
+REMINDER_WINDOW = int(os.environ.get("REMINDER_WINDOW", "5000"))
+REMINDER_BATCH = int(os.environ.get("REMINDER_BATCH", "100"))
+REMINDER_RETRY_DELAY = float(os.environ.get("REMINDER_RETRY_DELAY", "30"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+CURRENCY_API_URL = os.environ.get("CURRENCY_API_URL", "https://open.er-api.com/v6/latest/USD")
+CURRENCY_FILE = os.environ.get("CURRENCY_FILE", "")
+CURRENCY_TTL = float(os.environ.get("CURRENCY_TTL", "3600"))
+CURRENCY_RETRY = float(os.environ.get("CURRENCY_RETRY", "60"))
+TRANSLATE_BACKEND = os.environ.get("TRANSLATE_BACKEND", "google")
+TRANSLATE_WORKERS = int(os.environ.get("TRANSLATE_WORKERS", "4"))
+TRANSLATE_CACHE_SIZE = int(os.environ.get("TRANSLATE_CACHE_SIZE", "2048"))
+TRANSLATE_CACHE_TTL = float(os.environ.get("TRANSLATE_CACHE_TTL", "86400"))
+TRANSLATE_MAX_CHARS = int(os.environ.get("TRANSLATE_MAX_CHARS", "1000"))
+TRANSLATE_DETECT_CONFIDENCE = float(os.environ.get("TRANSLATE_DETECT_CONFIDENCE", "0.5"))
+TRANSLATE_LIKELY_LANGS = frozenset(os.environ.get("TRANSLATE_LIKELY_LANGS", "en,fr,es,de,tr,it,ru,fa,ur,id").split(","))
+WEATHER_BACKEND = os.environ.get("WEATHER_BACKEND", "open-meteo")
+WEATHER_API_URL = os.environ.get("WEATHER_API_URL", "https://api.open-meteo.com/v1/forecast")
+WEATHER_GEOCODE_URL = os.environ.get("WEATHER_GEOCODE_URL", "https://geocoding-api.open-meteo.com/v1/search")
+WEATHER_CACHE_TTL = float(os.environ.get("WEATHER_CACHE_TTL", "600"))
+XO_MATCH_TTL = float(os.environ.get("XO_MATCH_TTL", "3600"))
+XO_HISTORY_DAYS = int(os.environ.get("XO_HISTORY_DAYS", "7"))
+XO_SWEEP_INTERVAL = float(os.environ.get("XO_SWEEP_INTERVAL", "300"))
+XO_SWEEP_BATCH = int(os.environ.get("XO_SWEEP_BATCH", "200"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -44,6 +127,9 @@ logger = logging.getLogger(__name__)
 # حالات المحادثة
 (GUESS_GAME, XO_GAME, QUIZ_GAME, TODO_ADD, REMINDER_ADD, TRANSLATE_TEXT) = range(6)
 
+# أنواع التحديثات التي تعالجها المعالجات فعلاً
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 # ==================== نظام الصلاحيات ====================
 
 class Permission(Enum):
@@ -62,123 +148,834 @@ class AdminLevel(Enum):
     MODERATOR = "moderator"
     HELPER = "helper"
 
+# ==================== المقاييس ====================
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class CounterChild:
+    __slots__ = ('value',)
+    
+    def __init__(self):
+        self.value = 0
+    
+    def inc(self, amount=1):
+        self.value += amount
+
+class GaugeChild:
+    __slots__ = ('value',)
+    
+    def __init__(self):
+        self.value = 0
+    
+    def set(self, value):
+        self.value = value
+    
+    def inc(self, amount=1):
+        self.value += amount
+    
+    def dec(self, amount=1):
+        self.value -= amount
+
+class HistogramChild:
+    # عدادات غير تراكمية لكل فئة؛ التجميع التراكمي يحدث عند القراءة فقط
+    __slots__ = ('bounds', 'buckets', 'sum', 'count')
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metric:
+    # labels() يُستدعى مرة عند الإعداد ويُحفظ الابن؛ المسار الساخن لا ينشئ قواميس ولا مفاتيح
+    def __init__(self, kind, name, documentation, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+    
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: متوقع {len(self.labelnames)} وسوم")
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+    
+    def clear(self):
+        self._children.clear()
+
+class MetricsRegistry:
+    def __init__(self, prefix='bot_'):
+        self.prefix = prefix
+        self._metrics = []
+    
+    def _register(self, kind, name, documentation, labelnames, factory):
+        metric = Metric(kind, self.prefix + name, documentation, labelnames, factory)
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self._register('counter', name, documentation, labelnames, CounterChild)
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register('gauge', name, documentation, labelnames, GaugeChild)
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        bounds = tuple(sorted(buckets))
+        return self._register('histogram', name, documentation, labelnames, partial(HistogramChild, bounds))
+    
+    @staticmethod
+    def _escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    def _labels(self, names, values, extra=''):
+        pairs = [f'{name}="{self._escape(value)}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+    
+    def render(self):
+        # صيغة Prometheus النصية (0.0.4)
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for values, child in list(metric._children.items()):
+                if metric.kind != 'histogram':
+                    lines.append(f"{metric.name}{self._labels(metric.labelnames, values)} {child.value}")
+                    continue
+                total = 0
+                for bound, hits in zip(child.bounds + (None,), child.buckets):
+                    total += hits
+                    le = 'le="+Inf"' if bound is None else f'le="{bound!r}"'
+                    lines.append(f"{metric.name}_bucket{self._labels(metric.labelnames, values, le)} {total}")
+                labels = self._labels(metric.labelnames, values)
+                lines.append(f"{metric.name}_sum{labels} {child.sum}")
+                lines.append(f"{metric.name}_count{labels} {child.count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram('handler_seconds', 'زمن معالجة التحديث لكل أمر أو مسار زر', ('kind', 'name'))
+HANDLER_ERRORS = metrics.counter('handler_errors_total', 'استثناءات المعالجات', ('kind', 'name'))
+DB_SECONDS = metrics.histogram('db_query_seconds', 'زمن دوال Database شاملاً انتظار الخيط', ('method',))
+TELEGRAM_SECONDS = metrics.histogram('telegram_api_seconds', 'زمن طلبات Bot API', ('endpoint',))
+TELEGRAM_ERRORS = metrics.counter('telegram_api_errors_total', 'أخطاء Bot API حسب النوع', ('endpoint', 'error'))
+UPDATE_QUEUE = metrics.gauge('update_queue_depth', 'تحديثات تنتظر المعالجة').labels()
+OUTBOUND_QUEUE = metrics.gauge('outbound_queue_depth', 'رسائل تنتظر الإرسال').labels()
+REMINDERS_PENDING = metrics.gauge('reminders_pending', 'تذكيرات لم تُرسل بعد').labels()
+REMINDERS_SCHEDULED = metrics.gauge('reminders_scheduled', 'تذكيرات محمّلة في كومة المجدول').labels()
+CONVERSATIONS = metrics.gauge('conversations_active', 'محادثات في حالة غير منتهية', ('conversation',))
+
+def timed(kind, name):
+    # مثل CallbackRouter._wrap للأوامر والرسائل: الابن مربوط مرة واحدة عند التسجيل
+    seconds = HANDLER_SECONDS.labels(kind, name)
+    errors = HANDLER_ERRORS.labels(kind, name)
+    
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = time.perf_counter()
+            try:
+                return await func(update, context)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
 # ==================== قاعدة البيانات ====================
 
-class Database:
-    def __init__(self, db_path):
+class QueryStats:
+    __slots__ = ('count', 'total', 'rows', 'slow', 'plan', 'samples')
+    
+    def __init__(self, samples):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.plan = None
+        self.samples = deque(maxlen=samples)
+
+class QueryProfiler:
+    # تجميع حسب قالب الاستعلام: القيم الحرفية وقوائم IN (?, ?, ...) تُطوى ليصبح لكل دالة قالب واحد
+    LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    IN_LISTS = re.compile(r"IN \(\?(?:, ?\?)*\)", re.IGNORECASE)
+    EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+    
+    def __init__(self, slow_ms=DB_SLOW_QUERY_MS, samples=DB_PROFILE_SAMPLES):
+        self.slow_threshold = slow_ms / 1000
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._stats = {}
+        self.slow_log = deque(maxlen=20)
+        self.calls = 0
+    
+    def template(self, sql):
+        template = self._templates.get(sql)
+        if template is None:
+            template = self.IN_LISTS.sub('IN (?...)', self.LITERALS.sub('?', ' '.join(sql.split())))
+            if len(self._templates) >= 4096:
+                self._templates.clear()
+            self._templates[sql] = template
+        return template
+    
+    def record(self, cursor, sql, params, elapsed):
+        template = self.template(sql)
+        slow = elapsed >= self.slow_threshold
+        with self._lock:
+            entry = self._stats.get(template)
+            if entry is None:
+                entry = self._stats[template] = QueryStats(self.samples)
+            self.calls += 1
+            entry.count += 1
+            entry.total += elapsed
+            entry.samples.append(elapsed)
+            if cursor.description is None and cursor.rowcount > 0:
+                entry.rows += cursor.rowcount
+            if slow:
+                entry.slow += 1
+                self.slow_log.append((datetime.now(), template, elapsed))
+        if slow:
+            if entry.plan is None:
+                entry.plan = self.explain(cursor.connection, sql, params)
+            logger.warning("🐢 استعلام بطيء %.1f ms: %s | %s", elapsed * 1000, template, ' / '.join(entry.plan) or '-')
+        return entry
+    
+    def fetched(self, entry, elapsed, rows):
+        with self._lock:
+            entry.total += elapsed
+            entry.rows += rows
+    
+    def explain(self, conn, sql, params):
+        # مؤشر عادي حتى لا يُسجَّل EXPLAIN نفسه كاستعلام
+        if params is None or not sql.lstrip().upper().startswith(self.EXPLAINABLE):
+            return ()
+        try:
+            rows = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        except sqlite3.Error:
+            return ()
+        return tuple(row[3] for row in rows)
+    
+    def top(self, limit=10):
+        with self._lock:
+            items = [(template, entry.count, entry.total, entry.rows, entry.slow, sorted(entry.samples))
+                     for template, entry in self._stats.items()]
+        rows = []
+        for template, count, total, fetched, slow, samples in items:
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0
+            rows.append({'template': template, 'count': count, 'total_ms': total * 1000,
+                         'p99_ms': p99 * 1000, 'rows': fetched, 'slow': slow})
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+        return rows[:limit]
+    
+    def slow_count(self):
+        with self._lock:
+            return sum(entry.slow for entry in self._stats.values())
+
+class ProfilingCursor(sqlite3.Cursor):
+    # زمن execute يُسجَّل كعينة لـ p99، وزمن الجلب يُضاف إلى مجموع نفس القالب
+    _entry = None
+    
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._entry = self.connection.profiler.record(self, sql, parameters, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._entry = self.connection.profiler.record(self, sql, None, time.perf_counter() - started)
+    
+    def _fetched(self, started, rows):
+        if self._entry is not None:
+            self.connection.profiler.fetched(self._entry, time.perf_counter() - started, rows)
+    
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+    
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        rows = super().fetchmany(*args, **kwargs)
+        self._fetched(started, len(rows))
+        return rows
+    
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+    
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._fetched(started, 1)
+        return row
+
+class ProfilingConnection(sqlite3.Connection):
+    # Connection.execute في sqlite3 لا يمر بـ cursor()، لذا نعيد توجيهه صراحة
+    profiler = None
+    
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionPool:
+    PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16000",
+        "PRAGMA mmap_size = 134217728",
+        "PRAGMA foreign_keys = ON",
+    )
+    
+    def __init__(self, db_path, size=DB_POOL_SIZE, busy_timeout=DB_BUSY_TIMEOUT, profiler=None):
         self.db_path = db_path
-        self.init_db()
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.profiler = profiler
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        for _ in range(size):
+            self._idle.put(self._connect())
     
-    @contextmanager
-    def get_conn(self):
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+            factory=ProfilingConnection if self.profiler else sqlite3.Connection,
+        )
+        if self.profiler:
+            conn.profiler = self.profiler
         conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        # إعادة استخدام نفس الاتصال للاستدعاءات المتداخلة في نفس الخيط
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._idle.get()
+        waited = time.perf_counter() - started
+        self._record_wait(waited)
+        
+        self._local.conn = conn
         try:
             yield conn
         finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+    
+    def _record_wait(self, waited):
+        slow = waited >= DB_POOL_WAIT_WARN
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            if waited > self.wait_max:
+                self.wait_max = waited
+            if slow:
+                self.waits += 1
+        if slow:
+            logger.warning("⏳ انتظار اتصال قاعدة البيانات %.1f ms", waited * 1000)
+    
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'size': self.size,
+                'idle': self._idle.qsize(),
+                'checkouts': self.checkouts,
+                'slow_waits': self.waits,
+                'wait_total_ms': self.wait_total * 1000,
+                'wait_avg_ms': (self.wait_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                'wait_max_ms': self.wait_max * 1000,
+            }
+    
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
             conn.close()
+
+class Leaderboard:
+    # كل المستخدمين غير المحظورين مرتبين بالنقاط تنازلياً، تُحدّث مع كل تغيير بدل ORDER BY
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._order = []
+        self._users = {}
     
-    def init_db(self):
+    def load(self, rows):
+        with self._lock:
+            self._users = {
+                row['user_id']: [row['points'], row['first_name'], row['level'], row['total_games'] or 0]
+                for row in rows
+            }
+            self._order = sorted((-entry[0], user_id) for user_id, entry in self._users.items())
+    
+    def add(self, user_id, first_name, points, level, total_games=0):
+        with self._lock:
+            self._discard(user_id)
+            self._users[user_id] = [points, first_name, level, total_games]
+            insort(self._order, (-points, user_id))
+    
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+    
+    def _discard(self, user_id):
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            i = bisect_left(self._order, (-entry[0], user_id))
+            del self._order[i]
+    
+    def set_points(self, user_id, points, level):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            if entry[0] != points:
+                del self._order[bisect_left(self._order, (-entry[0], user_id))]
+                insort(self._order, (-points, user_id))
+            entry[0] = points
+            entry[2] = level
+    
+    def add_game(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                entry[3] += 1
+    
+    def top(self, limit=10):
+        with self._lock:
+            result = []
+            for _, user_id in self._order[:limit]:
+                points, first_name, level, total_games = self._users[user_id]
+                result.append({'first_name': first_name, 'points': points,
+                               'level': level, 'total_games': total_games})
+            return result
+    
+    def rank(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            return bisect_left(self._order, (-entry[0], user_id)) + 1
+    
+    def name(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            return entry[1] if entry else None
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._order)
+
+class LedgerWriter:
+    # صفوف points_history تتجمع في الذاكرة وتُكتب بـ executemany واحد
+    def __init__(self, max_pending=LEDGER_FLUSH_MAX):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._rows = []
+    
+    def append(self, user_id, points, reason, balance_after):
+        with self._lock:
+            self._rows.append((user_id, points, reason, datetime.now().isoformat(), balance_after))
+            return len(self._rows) >= self.max_pending
+    
+    def take(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            return rows
+    
+    def restore(self, rows):
+        with self._lock:
+            self._rows[:0] = rows
+    
+    def pending_for(self, user_id):
+        with self._lock:
+            rows = [row for row in self._rows if row[0] == user_id]
+        return [{'points': row[1], 'reason': row[2], 'date': row[3], 'balance_after': row[4]}
+                for row in reversed(rows)]
+
+class Database:
+    # كل ترحيل يعمل مرة واحدة داخل معاملة ويرفع PRAGMA user_version
+    MIGRATIONS = (
+        (1, '_migrate_base_schema'),
+        (2, '_migrate_indexes'),
+        (3, '_migrate_stats_counters'),
+        (4, '_migrate_broadcasts'),
+        (5, '_migrate_persistence'),
+        (6, '_migrate_xo_matches'),
+        (7, '_migrate_drop_leaderboard_index'),
+    )
+    
+    STATS_FIELDS = ('total_users', 'banned_users', 'total_points', 'total_admins',
+                    'banned_words', 'pending_todos', 'pending_reminders')
+    
+    TODOS_SQL = '''SELECT id, task, created_date FROM todos 
+                   WHERE user_id = ? AND completed = 0 
+                   ORDER BY created_date'''
+    DUE_REMINDERS_SQL = '''SELECT * FROM reminders 
+                           WHERE status = 'pending' AND remind_at <= ?'''
+    LEADERBOARD_SQL = '''SELECT user_id, first_name, points, level, total_games 
+                         FROM users WHERE is_banned = 0'''
+    BROADCAST_USERS_SQL = '''SELECT user_id FROM users 
+                             WHERE user_id > ? AND is_banned = 0 
+                             ORDER BY user_id LIMIT ?'''
+    PENDING_REMINDERS_SQL = '''SELECT id, remind_at FROM reminders 
+                               WHERE status = 'pending' AND remind_at <= ? 
+                               ORDER BY remind_at LIMIT ?'''
+    ADD_POINTS_SQL = '''UPDATE users SET points = points + ?, level = MAX(points + ?, 0) / 100 + 1 
+                        WHERE user_id = ? RETURNING points, level'''
+    POINTS_HISTORY_SQL = '''SELECT points, reason, date, balance_after FROM points_history 
+                            WHERE user_id = ? ORDER BY id DESC LIMIT ?'''
+    WARNINGS_SQL = '''SELECT warned_by, reason, warning_date FROM warnings 
+                      WHERE user_id = ? ORDER BY warning_date DESC'''
+    XO_SWEEP_SQL = '''DELETE FROM xo_games WHERE rowid IN (
+                        SELECT rowid FROM xo_games WHERE updated_at < ?
+                        AND (status IN ('waiting', 'active') OR updated_at < ?) LIMIT ?)
+                      RETURNING game_id'''
+    
+    HOT_QUERIES = {
+        'get_todos': (TODOS_SQL, (0,)),
+        'get_due_reminders': (DUE_REMINDERS_SQL, ('',)),
+        'get_pending_reminders': (PENDING_REMINDERS_SQL, ('', 1)),
+        'get_broadcast_user_ids': (BROADCAST_USERS_SQL, (0, 1)),
+        'get_points_history': (POINTS_HISTORY_SQL, (0, 10)),
+        'get_warnings': (WARNINGS_SQL, (0,)),
+        'sweep_xo_games': (XO_SWEEP_SQL, ('', '', 1)),
+    }
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, profiler=QueryProfiler() if DB_PROFILE else None)
+        self._banned = {}
+        self._admins = set()
+        self.leaderboard = Leaderboard()
+        self.ledger = LedgerWriter()
+        self._stats_cache = None
+        self._stats_at = 0.0
+        self.init_db()
+        self.load_permissions()
+        self.load_leaderboard()
+    
+    def get_conn(self):
+        return self.pool.connection()
+    
+    def load_permissions(self):
+        # حالة الحظر والإشراف تُقرأ مرة واحدة ثم تُحدّث من دوال الكتابة مباشرة
         with self.get_conn() as conn:
             c = conn.cursor()
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                points INTEGER DEFAULT 100,
-                level INTEGER DEFAULT 1,
-                join_date TEXT,
-                last_active TEXT,
-                warnings INTEGER DEFAULT 0,
-                is_banned INTEGER DEFAULT 0,
-                total_games INTEGER DEFAULT 0,
-                total_wins INTEGER DEFAULT 0
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                admin_level TEXT,
-                added_by INTEGER,
-                added_date TEXT,
-                permissions TEXT DEFAULT '[]'
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS banned (
-                user_id INTEGER PRIMARY KEY,
-                banned_by INTEGER,
-                reason TEXT,
-                ban_date TEXT,
-                ban_expiry TEXT
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS warnings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                warned_by INTEGER,
-                reason TEXT,
-                warning_date TEXT
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS banned_words (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                word TEXT UNIQUE,
-                added_by INTEGER,
-                added_date TEXT
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS todos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                task TEXT,
-                completed INTEGER DEFAULT 0,
-                created_date TEXT,
-                due_date TEXT,
-                completed_date TEXT
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS reminders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                chat_id INTEGER,
-                text TEXT,
-                remind_at TEXT,
-                created_at TEXT,
-                status TEXT DEFAULT 'pending'
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS points_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                points INTEGER,
-                reason TEXT,
-                date TEXT,
-                balance_after INTEGER
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS game_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                game_name TEXT,
-                games_played INTEGER DEFAULT 0,
-                games_won INTEGER DEFAULT 0,
-                high_score INTEGER DEFAULT 0,
-                UNIQUE(user_id, game_name)
-            )''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS xo_games (
-                game_id TEXT PRIMARY KEY,
-                player_x INTEGER,
-                player_o INTEGER,
-                board TEXT,
-                current_turn INTEGER,
-                status TEXT,
-                created_at TEXT,
-                winner INTEGER
-            )''')
-            
-            conn.commit()
+            c.execute('SELECT user_id, ban_expiry FROM banned')
+            self._banned = {row['user_id']: row['ban_expiry'] for row in c.fetchall()}
+            c.execute('SELECT user_id FROM admins')
+            self._admins = {row['user_id'] for row in c.fetchall()}
+    
+    def load_leaderboard(self):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute(self.LEADERBOARD_SQL)
+            self.leaderboard.load(c.fetchall())
+    
+    def pool_stats(self):
+        return self.pool.stats()
+    
+    def close(self):
+        self.pool.close()
+    
+    def init_db(self):
+        with self.get_conn() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for target, name in self.MIGRATIONS:
+                if version >= target:
+                    continue
+                conn.execute('BEGIN')
+                try:
+                    getattr(self, name)(conn.cursor())
+                    conn.execute(f'PRAGMA user_version = {target}')
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                version = target
+                logger.info("🗄 ترحيل قاعدة البيانات إلى الإصدار %s", target)
+            conn.execute('PRAGMA optimize')
+        self.check_query_plans()
+    
+    def _add_column(self, c, table, column, definition):
+        c.execute(f'PRAGMA table_info({table})')
+        if column not in {row['name'] for row in c.fetchall()}:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    
+    def _migrate_base_schema(self, c):
+        c.execute('''CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            points INTEGER DEFAULT 100,
+            level INTEGER DEFAULT 1,
+            join_date TEXT,
+            last_active TEXT,
+            warnings INTEGER DEFAULT 0,
+            is_banned INTEGER DEFAULT 0,
+            total_games INTEGER DEFAULT 0,
+            total_wins INTEGER DEFAULT 0
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            admin_level TEXT,
+            added_by INTEGER,
+            added_date TEXT,
+            permissions TEXT DEFAULT '[]'
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS banned (
+            user_id INTEGER PRIMARY KEY,
+            banned_by INTEGER,
+            reason TEXT,
+            ban_date TEXT,
+            ban_expiry TEXT
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS warnings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            warned_by INTEGER,
+            reason TEXT,
+            warning_date TEXT
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS banned_words (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            word TEXT UNIQUE,
+            added_by INTEGER,
+            added_date TEXT
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS todos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            task TEXT,
+            completed INTEGER DEFAULT 0,
+            created_date TEXT,
+            due_date TEXT,
+            completed_date TEXT
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            text TEXT,
+            remind_at TEXT,
+            created_at TEXT,
+            status TEXT DEFAULT 'pending'
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS points_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            points INTEGER,
+            reason TEXT,
+            date TEXT,
+            balance_after INTEGER
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS game_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            game_name TEXT,
+            games_played INTEGER DEFAULT 0,
+            games_won INTEGER DEFAULT 0,
+            high_score INTEGER DEFAULT 0,
+            UNIQUE(user_id, game_name)
+        )''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS xo_games (
+            game_id TEXT PRIMARY KEY,
+            player_x INTEGER,
+            player_o INTEGER,
+            board TEXT,
+            current_turn INTEGER,
+            status TEXT,
+            created_at TEXT,
+            winner INTEGER
+        )''')
+    
+    def _migrate_indexes(self, c):
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_todos_user_pending
+                     ON todos(user_id, created_date) WHERE completed = 0''')
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_reminders_pending
+                     ON reminders(remind_at) WHERE status = 'pending'""")
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+                     ON users(is_banned, points DESC)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_points_history_user
+                     ON points_history(user_id, id)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_warnings_user
+                     ON warnings(user_id, warning_date)''')
+    
+    def _migrate_stats_counters(self, c):
+        # صف واحد بالإحصائيات تحدّثه المشغلات (triggers) مع كل كتابة
+        c.execute('''CREATE TABLE IF NOT EXISTS bot_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            banned_users INTEGER NOT NULL DEFAULT 0,
+            total_points INTEGER NOT NULL DEFAULT 0,
+            total_admins INTEGER NOT NULL DEFAULT 0,
+            banned_words INTEGER NOT NULL DEFAULT 0,
+            pending_todos INTEGER NOT NULL DEFAULT 0,
+            pending_reminders INTEGER NOT NULL DEFAULT 0
+        )''')
+        c.execute('''INSERT OR REPLACE INTO bot_stats VALUES (1,
+            (SELECT COUNT(*) FROM users),
+            (SELECT COUNT(*) FROM users WHERE is_banned = 1),
+            (SELECT COALESCE(SUM(points), 0) FROM users),
+            (SELECT COUNT(*) FROM admins),
+            (SELECT COUNT(*) FROM banned_words),
+            (SELECT COUNT(*) FROM todos WHERE completed = 0),
+            (SELECT COUNT(*) FROM reminders WHERE status = 'pending'))''')
+        
+        c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE bot_stats SET total_users = total_users + 1,
+                banned_users = banned_users + (NEW.is_banned = 1),
+                total_points = total_points + COALESCE(NEW.points, 0) WHERE id = 1;
+        END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE bot_stats SET total_users = total_users - 1,
+                banned_users = banned_users - (OLD.is_banned = 1),
+                total_points = total_points - COALESCE(OLD.points, 0) WHERE id = 1;
+        END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_points AFTER UPDATE OF points ON users
+            WHEN NEW.points IS NOT OLD.points BEGIN
+            UPDATE bot_stats SET total_points = total_points + COALESCE(NEW.points, 0) - COALESCE(OLD.points, 0)
+                WHERE id = 1;
+        END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_banned AFTER UPDATE OF is_banned ON users
+            WHEN NEW.is_banned IS NOT OLD.is_banned BEGIN
+            UPDATE bot_stats SET banned_users = banned_users + (NEW.is_banned = 1) - (OLD.is_banned = 1)
+                WHERE id = 1;
+        END''')
+        
+        for table, column in (('admins', 'total_admins'), ('banned_words', 'banned_words')):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_insert AFTER INSERT ON {table} BEGIN
+                UPDATE bot_stats SET {column} = {column} + 1 WHERE id = 1;
+            END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_delete AFTER DELETE ON {table} BEGIN
+                UPDATE bot_stats SET {column} = {column} - 1 WHERE id = 1;
+            END''')
+        
+        for table, column, state, pending in (
+                ('todos', 'pending_todos', 'completed', 'completed = 0'),
+                ('reminders', 'pending_reminders', 'status', "status = 'pending'")):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_insert AFTER INSERT ON {table} BEGIN
+                UPDATE bot_stats SET {column} = {column} + (NEW.{pending}) WHERE id = 1;
+            END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_delete AFTER DELETE ON {table} BEGIN
+                UPDATE bot_stats SET {column} = {column} - (OLD.{pending}) WHERE id = 1;
+            END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_update AFTER UPDATE OF {state} ON {table} BEGIN
+                UPDATE bot_stats SET {column} = {column} + (NEW.{pending}) - (OLD.{pending}) WHERE id = 1;
+            END''')
+    
+    def _migrate_broadcasts(self, c):
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            chat_id INTEGER,
+            status_message_id INTEGER,
+            text TEXT,
+            last_user_id INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at TEXT,
+            finished_at TEXT
+        )''')
+    
+    def _migrate_persistence(self, c):
+        c.execute('''CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TEXT
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT,
+            key TEXT,
+            state INTEGER,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID''')
+    
+    def _migrate_xo_matches(self, c):
+        # version للتزامن المتفائل، ومعرفات رسالتي اللاعبين لتحديث اللوحة عند الطرفين
+        self._add_column(c, 'xo_games', 'version', 'INTEGER DEFAULT 0')
+        self._add_column(c, 'xo_games', 'x_message_id', 'INTEGER')
+        self._add_column(c, 'xo_games', 'o_message_id', 'INTEGER')
+        self._add_column(c, 'xo_games', 'updated_at', 'TEXT')
+        c.execute('UPDATE xo_games SET updated_at = COALESCE(created_at, ?) WHERE updated_at IS NULL',
+                  (datetime.now().isoformat(),))
+        c.execute('CREATE INDEX IF NOT EXISTS idx_xo_games_updated ON xo_games(updated_at)')
+    
+    def _migrate_drop_leaderboard_index(self, c):
+        # الترتيب حسب النقاط صار في الذاكرة (Leaderboard)؛ الفهرس يكلّف كل تحديث نقاط
+        # ويجرّ BROADCAST_USERS_SQL إلى ترتيب مؤقت بدل المرور على rowid
+        c.execute('DROP INDEX IF EXISTS idx_users_leaderboard')
+    
+    def check_query_plans(self):
+        # التأكد بـ EXPLAIN QUERY PLAN أن كل استعلام متكرر يستخدم فهرساً ولا يرتب في جدول مؤقت
+        plans = {}
+        with self.get_conn() as conn:
+            for name, (sql, params) in self.HOT_QUERIES.items():
+                details = [row['detail'] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+                plans[name] = details
+                if any((d.startswith('SCAN') and 'USING' not in d) or 'USE TEMP B-TREE' in d for d in details):
+                    logger.warning("⚠️ الاستعلام %s لا يستخدم فهرساً مناسباً: %s", name, details)
+        return plans
     
     def add_user(self, user_id, first_name, username=None):
         with self.get_conn() as conn:
@@ -188,7 +985,10 @@ class Database:
                 VALUES (?, ?, ?, ?, ?)''',
                 (user_id, username, first_name, 
                  datetime.now().isoformat(), datetime.now().isoformat()))
+            created = c.rowcount > 0
             conn.commit()
+        if created:
+            self.leaderboard.add(user_id, first_name, 100, 1)
     
     def get_user(self, user_id):
         with self.get_conn() as conn:
@@ -204,46 +1004,85 @@ class Database:
                      (datetime.now().isoformat(), user_id))
             conn.commit()
     
+    def update_activity_batch(self, items):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.executemany('UPDATE users SET last_active = ? WHERE user_id = ?',
+                          [(last_active, user_id) for user_id, last_active in items])
+            conn.commit()
+    
     def add_points(self, user_id, points, reason):
         with self.get_conn() as conn:
             c = conn.cursor()
-            c.execute('SELECT points FROM users WHERE user_id = ?', (user_id,))
-            current = c.fetchone()['points']
-            new_points = current + points
-            
-            c.execute('UPDATE users SET points = ? WHERE user_id = ?', (new_points, user_id))
-            
-            new_level = new_points // 100 + 1
-            c.execute('UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
-            
-            c.execute('''INSERT INTO points_history (user_id, points, reason, date, balance_after)
-                       VALUES (?, ?, ?, ?, ?)''',
-                     (user_id, points, reason, datetime.now().isoformat(), new_points))
+            c.execute(self.ADD_POINTS_SQL, (points, points, user_id))
+            row = c.fetchone()
             conn.commit()
-            return new_points
+        if row is None:
+            return None
+        self._points_changed(user_id, points, reason, row['points'], row['level'])
+        return row['points']
     
-    def is_admin(self, user_id):
-        if user_id in ADMIN_IDS:
-            return True
+    def add_points_bulk(self, awards, reason):
+        # عدة مستخدمين في معاملة واحدة (مكافآت المشرفين ونتائج الألعاب)
+        # تكرار المستخدم في الدفعة يُجمع أولاً حتى يطابق سجل النقاط الرصيد
+        totals = {}
+        for user_id, points in awards:
+            totals[user_id] = totals.get(user_id, 0) + points
+        results = {}
         with self.get_conn() as conn:
             c = conn.cursor()
-            c.execute('SELECT user_id FROM admins WHERE user_id = ?', (user_id,))
-            return c.fetchone() is not None
+            for user_id, points in totals.items():
+                c.execute(self.ADD_POINTS_SQL, (points, points, user_id))
+                row = c.fetchone()
+                if row is not None:
+                    results[user_id] = (points, row['points'], row['level'])
+            conn.commit()
+        for user_id, (points, new_points, new_level) in results.items():
+            self._points_changed(user_id, points, reason, new_points, new_level)
+        return {user_id: result[1] for user_id, result in results.items()}
+    
+    def _points_changed(self, user_id, points, reason, new_points, new_level):
+        self.leaderboard.set_points(user_id, new_points, new_level)
+        if self.ledger.append(user_id, points, reason, new_points):
+            self.flush_ledger()
+    
+    def flush_ledger(self):
+        rows = self.ledger.take()
+        if not rows:
+            return 0
+        try:
+            with self.get_conn() as conn:
+                c = conn.cursor()
+                c.executemany('''INSERT INTO points_history (user_id, points, reason, date, balance_after)
+                               VALUES (?, ?, ?, ?, ?)''', rows)
+                conn.commit()
+        except sqlite3.Error:
+            self.ledger.restore(rows)
+            raise
+        return len(rows)
+    
+    def is_admin(self, user_id):
+        return user_id in ADMIN_IDS or user_id in self._admins
     
     def add_admin(self, user_id, username, level, added_by):
         with self.get_conn() as conn:
             c = conn.cursor()
-            c.execute('''INSERT OR REPLACE INTO admins 
+            c.execute('''INSERT INTO admins 
                 (user_id, username, admin_level, added_by, added_date)
-                VALUES (?, ?, ?, ?, ?)''',
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username, admin_level = excluded.admin_level,
+                added_by = excluded.added_by, added_date = excluded.added_date''',
                 (user_id, username, level, added_by, datetime.now().isoformat()))
             conn.commit()
+        self._admins.add(user_id)
     
     def remove_admin(self, user_id):
         with self.get_conn() as conn:
             c = conn.cursor()
             c.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
             conn.commit()
+        self._admins.discard(user_id)
     
     def ban_user(self, user_id, banned_by, reason, days=None):
         with self.get_conn() as conn:
@@ -257,25 +1096,37 @@ class Database:
                 (user_id, banned_by, reason, datetime.now().isoformat(), ban_expiry))
             c.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,))
             conn.commit()
+        self._banned[user_id] = ban_expiry
+        self.leaderboard.remove(user_id)
     
     def unban_user(self, user_id):
         with self.get_conn() as conn:
             c = conn.cursor()
             c.execute('DELETE FROM banned WHERE user_id = ?', (user_id,))
             c.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (user_id,))
+            c.execute('''SELECT first_name, points, level, total_games 
+                       FROM users WHERE user_id = ?''', (user_id,))
+            row = c.fetchone()
             conn.commit()
+        self._banned.pop(user_id, None)
+        if row:
+            self.leaderboard.add(user_id, row['first_name'], row['points'], row['level'], row['total_games'] or 0)
+    
+    def ban_state(self, user_id):
+        # True/False من الذاكرة، و None إذا انتهت مدة الحظر ولم يُلغَ بعد
+        if user_id not in self._banned:
+            return False
+        expiry = self._banned.get(user_id)
+        if expiry and datetime.now().isoformat() > expiry:
+            return None
+        return True
     
     def is_banned(self, user_id):
-        with self.get_conn() as conn:
-            c = conn.cursor()
-            c.execute('SELECT ban_expiry FROM banned WHERE user_id = ?', (user_id,))
-            row = c.fetchone()
-            if not row:
-                return False
-            if row['ban_expiry'] and datetime.now().isoformat() > row['ban_expiry']:
-                self.unban_user(user_id)
-                return False
-            return True
+        state = self.ban_state(user_id)
+        if state is None:
+            self.unban_user(user_id)
+            return False
+        return state
     
     def warn_user(self, user_id, warned_by, reason):
         with self.get_conn() as conn:
@@ -289,6 +1140,21 @@ class Database:
             conn.commit()
             return count
     
+    def get_warnings(self, user_id):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute(self.WARNINGS_SQL, (user_id,))
+            return [dict(row) for row in c.fetchall()]
+    
+    def get_points_history(self, user_id, limit=10):
+        history = self.ledger.pending_for(user_id)[:limit]
+        if len(history) < limit:
+            with self.get_conn() as conn:
+                c = conn.cursor()
+                c.execute(self.POINTS_HISTORY_SQL, (user_id, limit - len(history)))
+                history += [dict(row) for row in c.fetchall()]
+        return history
+    
     def add_banned_word(self, word, added_by):
         with self.get_conn() as conn:
             c = conn.cursor()
@@ -308,32 +1174,27 @@ class Database:
             return [row['word'] for row in c.fetchall()]
     
     def get_top_users(self, limit=10):
-        with self.get_conn() as conn:
-            c = conn.cursor()
-            c.execute('''SELECT first_name, points, level, total_games 
-                       FROM users WHERE is_banned = 0 
-                       ORDER BY points DESC LIMIT ?''', (limit,))
-            return [dict(row) for row in c.fetchall()]
+        return self.leaderboard.top(limit)
+    
+    def get_rank(self, user_id):
+        return self.leaderboard.rank(user_id)
+    
+    def cached_stats(self):
+        if self._stats_cache is not None and time.monotonic() - self._stats_at < STATS_CACHE_TTL:
+            return dict(self._stats_cache)
+        return None
     
     def get_stats(self):
+        stats = self.cached_stats()
+        if stats is not None:
+            return stats
         with self.get_conn() as conn:
             c = conn.cursor()
-            stats = {}
-            c.execute('SELECT COUNT(*) as count FROM users')
-            stats['total_users'] = c.fetchone()['count']
-            c.execute('SELECT COUNT(*) as count FROM users WHERE is_banned = 1')
-            stats['banned_users'] = c.fetchone()['count']
-            c.execute('SELECT SUM(points) as total FROM users')
-            stats['total_points'] = c.fetchone()['total'] or 0
-            c.execute('SELECT COUNT(*) as count FROM admins')
-            stats['total_admins'] = c.fetchone()['count']
-            c.execute('SELECT COUNT(*) as count FROM banned_words')
-            stats['banned_words'] = c.fetchone()['count']
-            c.execute('SELECT COUNT(*) as count FROM todos WHERE completed = 0')
-            stats['pending_todos'] = c.fetchone()['count']
-            c.execute('SELECT COUNT(*) as count FROM reminders WHERE status = "pending"')
-            stats['pending_reminders'] = c.fetchone()['count']
-            return stats
+            c.execute(f'SELECT {", ".join(self.STATS_FIELDS)} FROM bot_stats WHERE id = 1')
+            stats = dict(c.fetchone())
+        self._stats_cache = stats
+        self._stats_at = time.monotonic()
+        return dict(stats)
     
     def add_todo(self, user_id, task):
         with self.get_conn() as conn:
@@ -347,9 +1208,7 @@ class Database:
     def get_todos(self, user_id):
         with self.get_conn() as conn:
             c = conn.cursor()
-            c.execute('''SELECT id, task, created_date FROM todos 
-                       WHERE user_id = ? AND completed = 0 
-                       ORDER BY created_date''', (user_id,))
+            c.execute(self.TODOS_SQL, (user_id,))
             return [dict(row) for row in c.fetchall()]
     
     def complete_todo(self, todo_id, user_id):
@@ -374,16 +1233,168 @@ class Database:
     def get_due_reminders(self):
         with self.get_conn() as conn:
             c = conn.cursor()
-            c.execute('''SELECT * FROM reminders 
-                       WHERE status = "pending" AND remind_at <= ?''',
-                     (datetime.now().isoformat(),))
+            c.execute(self.DUE_REMINDERS_SQL, (datetime.now().isoformat(),))
             return [dict(row) for row in c.fetchall()]
     
     def mark_reminder_sent(self, reminder_id):
         with self.get_conn() as conn:
             c = conn.cursor()
-            c.execute('UPDATE reminders SET status = "sent" WHERE id = ?', (reminder_id,))
+            c.execute("UPDATE reminders SET status = 'sent' WHERE id = ?", (reminder_id,))
+            conn.commit()
+    
+    def get_pending_reminders(self, until, limit):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute(self.PENDING_REMINDERS_SQL, (until, limit))
+            return [(row['remind_at'], row['id']) for row in c.fetchall()]
+    
+    def get_reminders(self, reminder_ids):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            marks = ','.join('?' * len(reminder_ids))
+            c.execute(f"SELECT id, chat_id, text FROM reminders WHERE id IN ({marks}) AND status = 'pending'",
+                      list(reminder_ids))
+            return [dict(row) for row in c.fetchall()]
+    
+    def set_reminders_status(self, reminder_ids, status):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.executemany('UPDATE reminders SET status = ? WHERE id = ?',
+                          [(status, reminder_id) for reminder_id in reminder_ids])
+            conn.commit()
+    
+    def create_broadcast(self, admin_id, chat_id, text):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''INSERT INTO broadcasts (admin_id, chat_id, text, created_at)
+                       VALUES (?, ?, ?, ?)''',
+                     (admin_id, chat_id, text, datetime.now().isoformat()))
+            conn.commit()
+            return c.lastrowid
+    
+    def set_broadcast_message(self, broadcast_id, message_id):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('UPDATE broadcasts SET status_message_id = ? WHERE id = ?', (message_id, broadcast_id))
+            conn.commit()
+    
+    def save_broadcast_progress(self, broadcast_id, last_user_id, delivered, failed, blocked, status='running'):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''UPDATE broadcasts SET last_user_id = ?, delivered = ?, failed = ?, blocked = ?,
+                       status = ?, finished_at = ? WHERE id = ?''',
+                     (last_user_id, delivered, failed, blocked, status,
+                      None if status == 'running' else datetime.now().isoformat(), broadcast_id))
+            conn.commit()
+    
+    def get_broadcasts(self, status=None, limit=1):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            if status:
+                c.execute('SELECT * FROM broadcasts WHERE status = ? ORDER BY id LIMIT ?', (status, limit))
+            else:
+                c.execute('SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?', (limit,))
+            return [dict(row) for row in c.fetchall()]
+    
+    def get_broadcast_user_ids(self, after_user_id, limit):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute(self.BROADCAST_USERS_SQL, (after_user_id, limit))
+            return [row['user_id'] for row in c.fetchall()]
+    
+    def get_persisted_user_data(self, user_id):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
+            return row['data'] if row else None
+    
+    def get_conversation_states(self, name):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+            return [(row['key'], row['state']) for row in c.fetchall()]
+    
+    def count_conversations(self):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('SELECT name, COUNT(*) FROM conversations GROUP BY name')
+            return c.fetchall()
+    
+    def save_persistence(self, users, conversations):
+        now = datetime.now().isoformat()
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.executemany('''INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+                           ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at''',
+                          [(user_id, data, now) for user_id, data in users if data is not None])
+            c.executemany('DELETE FROM user_data WHERE user_id = ?',
+                          [(user_id,) for user_id, data in users if data is None])
+            c.executemany('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                          [(name, key, state) for name, key, state in conversations if state is not None])
+            c.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',
+                          [(name, key) for name, key, state in conversations if state is None])
+            conn.commit()
+    
+    def create_xo_game(self, game_id, player_x, message_id):
+        now = datetime.now().isoformat()
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''INSERT INTO xo_games (game_id, player_x, board, current_turn, status,
+                       created_at, version, x_message_id, updated_at)
+                       VALUES (?, ?, ?, ?, 'waiting', ?, 0, ?, ?) RETURNING *''',
+                     (game_id, player_x, ' ' * 9, player_x, now, message_id, now))
+            row = dict(c.fetchone())
+            conn.commit()
+            return row
+    
+    def get_open_xo_games(self):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM xo_games WHERE status IN ('waiting', 'active')")
+            return [dict(row) for row in c.fetchall()]
+    
+    def get_stale_xo_games(self, stale_before):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute("""SELECT game_id, version FROM xo_games
+                         WHERE updated_at < ? AND status IN ('waiting', 'active')""", (stale_before,))
+            return [(row['game_id'], row['version']) for row in c.fetchall()]
+    
+    def join_xo_game(self, game_id, player_o):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''UPDATE xo_games SET player_o = ?, status = 'active', version = version + 1, updated_at = ?
+                       WHERE game_id = ? AND status = 'waiting' AND player_x != ? RETURNING *''',
+                     (player_o, datetime.now().isoformat(), game_id, player_o))
+            row = c.fetchone()
+            conn.commit()
+            return dict(row) if row else None
+    
+    def set_xo_message(self, game_id, message_id):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('UPDATE xo_games SET o_message_id = ? WHERE game_id = ?', (message_id, game_id))
+            conn.commit()
+    
+    def update_xo_game(self, game_id, version, board, current_turn, status, winner=None):
+        # لا يُكتب التحديث إلا إذا لم تتغير اللوحة منذ قراءتها (نقرة مزدوجة أو لاعبان معاً)
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute('''UPDATE xo_games SET board = ?, current_turn = ?, status = ?, winner = ?,
+                       version = version + 1, updated_at = ?
+                       WHERE game_id = ? AND version = ?''',
+                     (board, current_turn, status, winner, datetime.now().isoformat(), game_id, version))
+            conn.commit()
+            return c.rowcount == 1
+    
+    def sweep_xo_games(self, stale_before, finished_before, limit=XO_SWEEP_BATCH):
+        with self.get_conn() as conn:
+            c = conn.cursor()
+            c.execute(self.XO_SWEEP_SQL, (stale_before, finished_before, limit))
+            removed = [row['game_id'] for row in c.fetchall()]
             conn.commit()
+            return removed
     
     def update_game_stats(self, user_id, game_name, won=False, score=0):
         with self.get_conn() as conn:
@@ -400,13 +1411,771 @@ class Database:
             if won:
                 c.execute('UPDATE users SET total_wins = total_wins + 1 WHERE user_id = ?', (user_id,))
             conn.commit()
+        self.leaderboard.add_game(user_id)
 
-db = Database(DATABASE_NAME)
-
-# ==================== دوال مساعدة ====================
-
-class Utilities:
-    @staticmethod
+class AsyncDatabase:
+    # عمليات القراءة تعمل على عدة خيوط، والكتابة على خيط واحد لتجنب تنافس أقفال SQLite
+    READ_METHODS = frozenset({
+        'get_user', 'get_banned_words', 'get_todos',
+        'get_due_reminders', 'get_warnings', 'get_points_history',
+        'get_pending_reminders', 'get_reminders', 'get_broadcasts', 'get_broadcast_user_ids',
+        'get_persisted_user_data', 'get_conversation_states', 'get_open_xo_games', 'get_stale_xo_games',
+        'count_conversations',
+    })
+    
+    def __init__(self, database, readers=max(DB_POOL_SIZE - 1, 1)):
+        self.sync = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+    
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+        if name.startswith('_') or not callable(method):
+            return method
+        executor = self._readers if name in self.READ_METHODS else self._writer
+        seconds = DB_SECONDS.labels(name)
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                return await loop.run_in_executor(executor, partial(method, *args, **kwargs))
+            finally:
+                seconds.observe(time.perf_counter() - started)
+        
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+    
+    # فحص الصلاحيات من الذاكرة مباشرة دون المرور بخيوط قاعدة البيانات
+    async def is_admin(self, user_id):
+        return self.sync.is_admin(user_id)
+    
+    async def is_banned(self, user_id):
+        state = self.sync.ban_state(user_id)
+        if state is None:
+            await self.unban_user(user_id)
+            return False
+        return state
+    
+    async def get_stats(self):
+        stats = self.sync.cached_stats()
+        if stats is None:
+            loop = asyncio.get_running_loop()
+            stats = await loop.run_in_executor(self._readers, self.sync.get_stats)
+        return stats
+    
+    async def get_top_users(self, limit=10):
+        return self.sync.get_top_users(limit)
+    
+    async def get_rank(self, user_id):
+        return self.sync.get_rank(user_id)
+    
+    def shutdown(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+class ActivityBuffer:
+    # يحتفظ بآخر نشاط لكل مستخدم في الذاكرة ويكتبه دفعة واحدة
+    def __init__(self, adb, interval=ACTIVITY_FLUSH_INTERVAL, max_pending=ACTIVITY_FLUSH_MAX):
+        self.adb = adb
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._task = None
+        self._flush_task = None
+        self.touches = 0
+        self.flushes = 0
+    
+    def touch(self, user_id):
+        self._pending[user_id] = datetime.now().isoformat()
+        self.touches += 1
+        if len(self._pending) >= self.max_pending and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_now())
+    
+    def last_active(self, user_id, default=None):
+        return self._pending.get(user_id, default)
+    
+    async def _flush_now(self):
+        try:
+            await self.flush()
+        finally:
+            self._flush_task = None
+    
+    async def flush(self):
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        try:
+            await self.adb.update_activity_batch(list(batch.items()))
+        except Exception:
+            logger.exception("❌ فشل حفظ النشاط")
+            for user_id, last_active in batch.items():
+                self._pending.setdefault(user_id, last_active)
+            return 0
+        self.flushes += 1
+        return len(batch)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+db = Database(DATABASE_NAME)
+adb = AsyncDatabase(db)
+activity = ActivityBuffer(adb)
+
+# ==================== قائمة الإرسال ====================
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+class OutboundJob:
+    __slots__ = ('chat_id', 'edit_key', 'priority', 'callback', 'args', 'kwargs', 'futures', 'attempts', 'endpoint')
+    
+    def __init__(self, chat_id, edit_key, priority, callback, args, kwargs, future, endpoint):
+        self.chat_id = chat_id
+        self.endpoint = endpoint
+        self.edit_key = edit_key
+        self.priority = priority
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.attempts = 0
+
+class OutboundDispatcher(BaseRateLimiter):
+    # كل طلبات Bot API تمر من هنا: حد عام وحد لكل محادثة، والردود التفاعلية قبل الإرسال الخلفي
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    
+    MESSAGE_ENDPOINTS = frozenset({
+        'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto',
+        'sendDocument', 'sendAudio', 'sendVoice', 'sendVideo', 'sendSticker',
+        'copyMessage', 'forwardMessage',
+    })
+    EDIT_ENDPOINTS = frozenset({'editMessageText', 'editMessageReplyMarkup'})
+    
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_interval = 1 / chat_rate
+        # الردود التفاعلية تستهلك رصيد المحادثة مقدماً حتى chat_burst رسائل، ثم تلتزم بنفس المعدل
+        self.chat_allowance = self.chat_interval * max(chat_burst - 1, 0)
+        self.max_retries = max_retries
+        self._delayed = []
+        self._ready = []
+        self._pending_edits = {}
+        self._chat_ready = {}
+        self._tokens = global_rate
+        self._stamp = 0.0
+        self._seq = 0
+        self._wake = None
+        self._task = None
+        self.sent = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._timers = {}
+        self._inflight = set()
+    
+    async def initialize(self):
+        # ExtBot.initialize يستدعينا من Application وUpdater معاً: حلقة واحدة فقط
+        if self._task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._stamp = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+    
+    async def shutdown(self):
+        if self._task is None:
+            return
+        deadline = time.monotonic() + OUTBOUND_DRAIN_TIMEOUT
+        while (self._delayed or self._ready or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # الطلبات التي لم تنته خلال مهلة التفريغ تُلغى وتُنتظر حتى لا تبقى معلقة
+        pending = list(self._inflight)
+        for sending in pending:
+            sending.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for queue_ in (self._delayed, self._ready):
+            for entry in queue_:
+                for future in entry[-1].futures:
+                    if not future.done():
+                        future.cancel()
+            queue_.clear()
+        self._pending_edits.clear()
+    
+    def depth(self):
+        return len(self._delayed) + len(self._ready)
+    
+    def stats(self):
+        return {'queued': self.depth(), 'sent': self.sent, 'retries': self.retries,
+                'coalesced': self.coalesced, 'errors': self.errors}
+    
+    async def _call(self, endpoint, callback, args, kwargs):
+        # زمن الطلب الفعلي إلى Telegram، دون وقت الانتظار في القائمة
+        seconds = self._timers.get(endpoint)
+        if seconds is None:
+            seconds = self._timers[endpoint] = TELEGRAM_SECONDS.labels(endpoint)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except TelegramError as e:
+            TELEGRAM_ERRORS.labels(endpoint, type(e).__name__).inc()
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - started)
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if endpoint not in self.MESSAGE_ENDPOINTS or chat_id is None or self._task is None:
+            return await self._call(endpoint, callback, args, kwargs)
+        
+        future = asyncio.get_running_loop().create_future()
+        edit_key = None
+        if endpoint in self.EDIT_ENDPOINTS and data.get('message_id') is not None:
+            edit_key = (endpoint, chat_id, data['message_id'])
+            job = self._pending_edits.get(edit_key)
+            if job is not None:
+                # تعديل أحدث لنفس الرسالة قبل إرسال السابق: نرسل الأحدث فقط
+                job.callback, job.args, job.kwargs = callback, args, kwargs
+                job.futures.append(future)
+                self.coalesced += 1
+                return await future
+        
+        priority = self.INTERACTIVE if rate_limit_args is None else rate_limit_args
+        job = OutboundJob(chat_id, edit_key, priority, callback, args, kwargs, future, endpoint)
+        if edit_key:
+            self._pending_edits[edit_key] = job
+        self._push(time.monotonic(), job)
+        return await future
+    
+    def _push(self, slot, job):
+        self._seq += 1
+        heapq.heappush(self._delayed, (slot, job.priority, self._seq, job))
+        self._wake.set()
+    
+    def _take_token(self, now):
+        self._tokens = min(self.global_rate, self._tokens + (now - self._stamp) * self.global_rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.global_rate
+    
+    async def _run(self):
+        next_sweep = time.monotonic() + 60
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, job = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, job))
+            if self._ready:
+                job = self._ready[0][-1]
+                chat_ready = self._chat_ready.get(job.chat_id, 0.0)
+                allowed_at = chat_ready - self.chat_allowance if job.priority == self.INTERACTIVE else chat_ready
+                if allowed_at > now:
+                    # المحادثة تجاوزت حدها: نؤجل هذه الرسالة ونكمل مع غيرها
+                    heapq.heappop(self._ready)
+                    self._push(allowed_at, job)
+                    continue
+                wait = self._take_token(now)
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                heapq.heappop(self._ready)
+                self._chat_ready[job.chat_id] = max(chat_ready, now) + self.chat_interval
+                if job.edit_key and self._pending_edits.get(job.edit_key) is job:
+                    del self._pending_edits[job.edit_key]
+                # الحلقة لا تحتفظ إلا بمراجع ضعيفة للمهام، فنحفظها هنا حتى تنتهي
+                sending = asyncio.create_task(self._execute(job))
+                self._inflight.add(sending)
+                sending.add_done_callback(self._inflight.discard)
+                continue
+            if now >= next_sweep:
+                for chat_id in [c for c, ready in self._chat_ready.items() if ready < now]:
+                    del self._chat_ready[chat_id]
+                next_sweep = now + 60
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _execute(self, job):
+        try:
+            result = await self._call(job.endpoint, job.callback, job.args, job.kwargs)
+        except asyncio.CancelledError:
+            for future in job.futures:
+                if not future.done():
+                    future.cancel()
+            raise
+        except RetryAfter as e:
+            if job.attempts < self.max_retries:
+                job.attempts += 1
+                self.retries += 1
+                slot = time.monotonic() + retry_after_seconds(e)
+                self._chat_ready[job.chat_id] = max(self._chat_ready.get(job.chat_id, 0.0), slot)
+                self._push(slot, job)
+                return
+            self._finish(job, error=e)
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self.sent += 1
+            self._finish(job, result=result)
+    
+    def _finish(self, job, result=None, error=None):
+        if error is not None:
+            self.errors += 1
+        for future in job.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+outbound = OutboundDispatcher()
+
+# ==================== مجدول التذكيرات ====================
+
+class ReminderScheduler:
+    # كومة صغرى بالتذكيرات المستحقة خلال نافذة زمنية فقط، والباقي يبقى في قاعدة البيانات
+    def __init__(self, adb, horizon=REMINDER_HORIZON, window=REMINDER_WINDOW, batch=REMINDER_BATCH):
+        self.adb = adb
+        self.horizon = horizon
+        self.window = window
+        self.batch = batch
+        self.bot = None
+        self._heap = []
+        self._horizon_end = ''
+        self._wake = None
+        self._task = None
+        self.sent = 0
+        self.failed = 0
+    
+    def schedule(self, reminder_id, remind_at):
+        remind_at = remind_at.isoformat()
+        if remind_at <= self._horizon_end:
+            heapq.heappush(self._heap, (remind_at, reminder_id))
+            if self._wake:
+                self._wake.set()
+    
+    def __len__(self):
+        return len(self._heap)
+    
+    async def _reload(self):
+        horizon_end = (datetime.now() + timedelta(seconds=self.horizon)).isoformat()
+        heap = await self.adb.get_pending_reminders(horizon_end, self.window)
+        heapq.heapify(heap)
+        self._heap = heap
+        # عند امتلاء النافذة نكتفي بآخر موعد محمّل ونعيد التحميل بعده
+        self._horizon_end = horizon_end if len(heap) < self.window else max(heap)[0]
+    
+    async def _run(self):
+        while True:
+            try:
+                now = datetime.now().isoformat()
+                if now >= self._horizon_end and (not self._heap or self._heap[0][0] > now):
+                    await self._reload()
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch:
+                    due.append(heapq.heappop(self._heap)[1])
+                if due:
+                    await self._deliver(due)
+                    continue
+                next_at = self._heap[0][0] if self._heap else self._horizon_end
+                timeout = (datetime.fromisoformat(next_at) - datetime.now()).total_seconds()
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("❌ خطأ في مجدول التذكيرات")
+                await asyncio.sleep(5)
+    
+    async def _deliver(self, reminder_ids):
+        sent, failed = [], []
+        retry_at = (datetime.now() + timedelta(seconds=REMINDER_RETRY_DELAY)).isoformat()
+        rows = await self.adb.get_reminders(reminder_ids)
+        results = await asyncio.gather(*[
+            self.bot.send_message(
+                chat_id=row['chat_id'],
+                text=f"⏰ **تذكير**\n\n{escape_markdown(row['text'])}",
+                parse_mode=ParseMode.MARKDOWN,
+                rate_limit_args=OutboundDispatcher.BACKGROUND
+            )
+            for row in rows
+        ], return_exceptions=True)
+        for row, result in zip(rows, results):
+            if not isinstance(result, Exception):
+                sent.append(row['id'])
+            elif isinstance(result, (Forbidden, BadRequest)):
+                failed.append(row['id'])
+            elif isinstance(result, RetryAfter):
+                retry = (datetime.now() + timedelta(seconds=retry_after_seconds(result))).isoformat()
+                heapq.heappush(self._heap, (retry, row['id']))
+            else:
+                if not isinstance(result, TelegramError):
+                    logger.error("❌ فشل إرسال التذكير %s: %r", row['id'], result)
+                heapq.heappush(self._heap, (retry_at, row['id']))
+        if sent:
+            await self.adb.set_reminders_status(sent, 'sent')
+        if failed:
+            await self.adb.set_reminders_status(failed, 'failed')
+        self.sent += len(sent)
+        self.failed += len(failed)
+    
+    def start(self, bot):
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+reminders = ReminderScheduler(adb)
+
+# ==================== البث الجماعي ====================
+
+class BroadcastManager:
+    # يمر على المستخدمين بترقيم keyset ويحفظ آخر معرف بعد كل صفحة ليُستأنف بعد إعادة التشغيل
+    STATUS_LABELS = {'running': "⏳ جارٍ", 'done': "✅ اكتمل"}
+    
+    def __init__(self, adb, page_size=BROADCAST_PAGE_SIZE):
+        self.adb = adb
+        self.page_size = page_size
+        self.bot = None
+        self._tasks = {}
+        self._progress = {}
+    
+    def is_running(self):
+        return bool(self._tasks)
+    
+    def progress(self, broadcast_id):
+        return self._progress.get(broadcast_id)
+    
+    def format_progress(self, row):
+        return (
+            f"📢 **البث #{row['id']}**\n"
+            f"━━━━━━━━━━━━━━━━━━\n"
+            f"✅ وصلت: {row['delivered']}\n"
+            f"🚫 حظروا البوت: {row['blocked']}\n"
+            f"⚠️ فشلت: {row['failed']}\n"
+            f"📍 الحالة: {self.STATUS_LABELS.get(row['status'], row['status'])}"
+        )
+    
+    async def start(self, bot, admin_id, chat_id, text):
+        self.bot = bot
+        broadcast_id = await self.adb.create_broadcast(admin_id, chat_id, text)
+        row = {'id': broadcast_id, 'admin_id': admin_id, 'chat_id': chat_id, 'text': text,
+               'status_message_id': None, 'last_user_id': 0,
+               'delivered': 0, 'failed': 0, 'blocked': 0, 'status': 'running'}
+        message = await bot.send_message(chat_id=chat_id, text=self.format_progress(row),
+                                         parse_mode=ParseMode.MARKDOWN)
+        row['status_message_id'] = message.message_id
+        await self.adb.set_broadcast_message(broadcast_id, message.message_id)
+        self._launch(row)
+        return broadcast_id
+    
+    async def resume(self, bot):
+        self.bot = bot
+        for row in await self.adb.get_broadcasts(status='running', limit=100):
+            logger.info("📢 استئناف البث #%s بعد المستخدم %s", row['id'], row['last_user_id'])
+            self._launch(row)
+    
+    def _launch(self, row):
+        self._progress[row['id']] = row
+        self._tasks[row['id']] = asyncio.create_task(self._run(row))
+    
+    async def _run(self, row):
+        try:
+            while True:
+                user_ids = await self.adb.get_broadcast_user_ids(row['last_user_id'], self.page_size)
+                if not user_ids:
+                    break
+                results = await asyncio.gather(*[
+                    self.bot.send_message(chat_id=user_id, text=row['text'],
+                                          rate_limit_args=OutboundDispatcher.BACKGROUND)
+                    for user_id in user_ids
+                ], return_exceptions=True)
+                for result in results:
+                    if not isinstance(result, Exception):
+                        row['delivered'] += 1
+                    elif isinstance(result, Forbidden):
+                        row['blocked'] += 1
+                    else:
+                        row['failed'] += 1
+                row['last_user_id'] = user_ids[-1]
+                await self.adb.save_broadcast_progress(row['id'], row['last_user_id'],
+                                                       row['delivered'], row['failed'], row['blocked'])
+                await self._report(row)
+            row['status'] = 'done'
+            await self.adb.save_broadcast_progress(row['id'], row['last_user_id'], row['delivered'],
+                                                   row['failed'], row['blocked'], status='done')
+            await self._report(row)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("❌ خطأ في البث #%s", row['id'])
+        finally:
+            self._tasks.pop(row['id'], None)
+    
+    async def _report(self, row):
+        if not row.get('status_message_id'):
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=row['chat_id'], message_id=row['status_message_id'],
+                text=self.format_progress(row), parse_mode=ParseMode.MARKDOWN,
+                rate_limit_args=OutboundDispatcher.BACKGROUND
+            )
+        except TelegramError:
+            pass
+    
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+
+broadcasts = BroadcastManager(adb)
+
+# ==================== حفظ الحالة ====================
+
+class SQLitePersistence(BasePersistence):
+    # user_data وحالات المحادثات في bot.db: تحميل كسول لكل مستخدم، وكتابة ما تغير فقط
+    def __init__(self, adb, update_interval=PERSISTENCE_INTERVAL, idle_ttl=PERSISTENCE_IDLE_TTL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.adb = adb
+        # المستخدمون المحمّلون مرتبون بآخر نشاط؛ الخامل أكثر من idle_ttl يُنسى ويُعاد تحميله عند عودته
+        self.idle_ttl = idle_ttl
+        self._loaded = OrderedDict()
+        self._hashes = {}
+        self._next_sweep = time.monotonic() + idle_ttl
+        self._dirty_users = {}
+        self._dirty_conversations = {}
+        self._flush_task = None
+        self.writes = 0
+        self.skipped = 0
+    
+    @staticmethod
+    def _dump(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    
+    async def get_user_data(self):
+        return {}
+    
+    async def refresh_user_data(self, user_id, user_data):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        if user_id in self._loaded:
+            self._loaded[user_id] = now
+            self._loaded.move_to_end(user_id)
+            return
+        self._loaded[user_id] = now
+        raw = await self.adb.get_persisted_user_data(user_id)
+        if raw is not None:
+            self._hashes[user_id] = hash(raw)
+            for key, value in json.loads(raw).items():
+                user_data.setdefault(key, value)
+    
+    async def update_user_data(self, user_id, data):
+        try:
+            raw = self._dump(data) if data else None
+        except (TypeError, ValueError):
+            logger.warning("⚠️ بيانات غير قابلة للحفظ للمستخدم %s", user_id)
+            return
+        digest = hash(raw)
+        if self._hashes.get(user_id) == digest:
+            self.skipped += 1
+            return
+        if user_id in self._loaded:
+            self._hashes[user_id] = digest
+        self._dirty_users[user_id] = raw
+        self._schedule_flush()
+    
+    def sweep(self, now):
+        # الأقدم نشاطاً في البداية: نتوقف عند أول مستخدم نشط
+        while self._loaded:
+            user_id, seen = next(iter(self._loaded.items()))
+            if now - seen < self.idle_ttl:
+                break
+            del self._loaded[user_id]
+            self._hashes.pop(user_id, None)
+        self._next_sweep = now + min(self.idle_ttl, 60)
+    
+    async def drop_user_data(self, user_id):
+        self._hashes.pop(user_id, None)
+        self._dirty_users[user_id] = None
+        self._schedule_flush()
+    
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in await self.adb.get_conversation_states(name)}
+    
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, self._dump(list(key)))] = new_state
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        # كل تحديثات الدورة الواحدة تُكتب في معاملة واحدة بعد انتهائها
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+    
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._flush_task = None
+        await self.flush()
+    
+    async def flush(self):
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not users and not conversations:
+            return
+        await self.adb.save_persistence(
+            list(users.items()),
+            [(name, key, state) for (name, key), state in conversations.items()],
+        )
+        self.writes += len(users) + len(conversations)
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+persistence = SQLitePersistence(adb)
+
+# ==================== الحماية من الإغراق ====================
+
+class FloodControl:
+    # دلو رموز لكل (مستخدم، نوع إجراء): [الرموز المتبقية، آخر تحديث]
+    GAME_PREFIXES = ('game_', 'quiz_', 'xo_', 'pvp_')
+    
+    def __init__(self, rates=FLOOD_RATES, idle_ttl=FLOOD_IDLE_TTL):
+        self.rates = self.parse_rates(rates)
+        self.idle_ttl = max([idle_ttl] + [burst / rate for rate, burst in self.rates.values() if rate > 0])
+        self._buckets = {}
+        self._next_sweep = time.monotonic() + idle_ttl
+        self.throttled = 0
+    
+    @staticmethod
+    def parse_rates(spec):
+        rates = {}
+        for item in spec.split(','):
+            action, _, value = item.strip().partition('=')
+            rate, _, burst = value.partition('/')
+            rates[action] = (float(rate), float(burst or 1))
+        return rates
+    
+    def classify(self, update):
+        if update.callback_query:
+            data = update.callback_query.data or ''
+            return 'game' if data.startswith(self.GAME_PREFIXES) else 'callback'
+        message = update.message
+        if message and message.text:
+            return 'command' if message.text.startswith('/') else 'message'
+        return None
+    
+    def allow(self, user_id, action):
+        limit = self.rates.get(action)
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        key = (user_id, action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [burst - 1, now]
+            return True
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.throttled += 1
+            return False
+        bucket[0] = tokens - 1
+        return True
+    
+    def sweep(self, now):
+        # الدلو الخامل لفترة كافية يكون ممتلئاً، فحذفه لا يغير شيئاً
+        cutoff = now - self.idle_ttl
+        for key in [k for k, bucket in self._buckets.items() if bucket[1] < cutoff]:
+            del self._buckets[key]
+        self._next_sweep = now + self.idle_ttl
+    
+    def __len__(self):
+        return len(self._buckets)
+
+flood = FloodControl()
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None or db.is_admin(user.id):
+        return
+    action = flood.classify(update)
+    if action is None or flood.allow(user.id, action):
+        return
+    if update.callback_query:
+        await update.callback_query.answer("⏳ على مهلك! حاول بعد لحظات")
+    raise ApplicationHandlerStop
+
+# ==================== دوال مساعدة ====================
+
+class Utilities:
+    @staticmethod
     def get_level_emoji(points):
         if points < 500:
             return "🥉"
@@ -460,83 +2229,997 @@ class Utilities:
         ]
         return random.choice(quotes)
 
+# ==================== فلتر الكلمات الممنوعة ====================
+
+# توحيد أشكال الحروف العربية وحذف التشكيل والتطويل قبل المطابقة
+ARABIC_NORMALIZATION = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    'ـ': None, 'ٰ': None,
+    **{chr(c): None for c in range(0x064B, 0x0653)},
+})
+
+def normalize_arabic(text):
+    return text.translate(ARABIC_NORMALIZATION).casefold()
+
+class WordMatcher:
+    # آلة Aho-Corasick: مرور واحد على النص مهما كان عدد الكلمات
+    REPEATS = re.compile(r'(.)\1{2,}')
+    # سوابق تلتصق بالكلمة العربية (الكلب، والكلب، ياكلب) فلا تُعد حرفاً قبلها
+    CLITICS = frozenset({
+        'ال', 'و', 'ف', 'ب', 'ك', 'ل', 'يا', 'لل',
+        'وال', 'فال', 'بال', 'كال', 'ولل', 'فلل',
+        'وب', 'فب', 'وك', 'فك', 'ول', 'فل', 'ويا', 'فيا',
+    })
+    
+    def __init__(self, words):
+        self.words = []
+        self._lengths = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for word in words:
+            pattern = self.prepare(word)
+            if pattern:
+                self._insert(pattern, len(self.words))
+                self.words.append(word)
+                self._lengths.append(len(pattern))
+        self._link()
+        # كل كلمة يجب أن تطابق نفسها بعد نفس التوحيد، وإلا فلن تُلتقط أبداً
+        for word in self.words:
+            if self.search(word) is None:
+                logger.warning("⚠️ الكلمة الممنوعة %r لا تطابق نفسها بعد التوحيد", word)
+    
+    @classmethod
+    def prepare(cls, text):
+        # نفس التوحيد للكلمات والنص: شكل الحروف، مسافة واحدة بين الكلمات،
+        # وتكرار الحرف ثلاث مرات فأكثر يُعامل كحرف واحد (كلللمة = كلمة) والحرف المضاعف يبقى
+        return cls.REPEATS.sub(r'\1', ' '.join(normalize_arabic(text).split()))
+    
+    def _starts_word(self, text, start):
+        if start == 0 or not text[start - 1].isalnum():
+            return True
+        for size in (1, 2, 3):
+            head = start - size
+            if head < 0:
+                break
+            if (head == 0 or not text[head - 1].isalnum()) and text[head:start] in self.CLITICS:
+                return True
+        return False
+    
+    def _insert(self, pattern, index):
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        if not self._out[state]:
+            self._out[state] = (index,)
+    
+    def _link(self):
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for ch, nxt in self._goto[state].items():
+                pending.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                # كل الكلمات المنتهية هنا، لأن الأطول قد يفشل في حدود الكلمة والأقصر ينجح
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+    
+    def search(self, text):
+        goto, fail, out, lengths = self._goto, self._fail, self._out, self._lengths
+        text = self.prepare(text)
+        last = len(text) - 1
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if not out[state] or (i < last and text[i + 1].isalnum()):
+                continue
+            # كلمة كاملة فقط: لا حرف قبلها (عدا السوابق) ولا بعدها (he لا تطابق the ولا hello)
+            for index in out[state]:
+                if self._starts_word(text, i - lengths[index] + 1):
+                    return self.words[index]
+        return None
+
+class BannedWordsFilter:
+    def __init__(self):
+        self._matcher = WordMatcher([])
+        self.hits = Counter()
+        self.checked = 0
+    
+    def reload(self, words):
+        # بناء آلة جديدة ثم استبدالها دفعة واحدة
+        self._matcher = WordMatcher(words)
+    
+    def __len__(self):
+        return len(self._matcher.words)
+    
+    def check(self, text):
+        self.checked += 1
+        word = self._matcher.search(text)
+        if word is not None:
+            self.hits[word] += 1
+        return word
+
+word_filter = BannedWordsFilter()
+word_filter.reload(db.get_banned_words())
+
+async def word_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None or db.is_admin(user.id):
+        return
+    if word_filter.check(update.message.text) is None:
+        return
+    await update.message.reply_text("⚠️ رسالتك تحتوي على كلمة ممنوعة")
+    raise ApplicationHandlerStop
+
+# ==================== الشاشات الجاهزة ====================
+
+def build_keyboard(rows):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data) for text, data in row] for row in rows])
+
+MAIN_MENU_ROWS = (
+    (("🎮 الألعاب", "games_menu"), ("📊 الخدمات", "services_menu")),
+    (("👤 حسابي", "profile"), ("🏆 المتصدرين", "leaderboard")),
+    (("📝 المهام", "todos_menu"), ("⏰ التذكيرات", "reminders_menu")),
+    (("ℹ️ المساعدة", "help"), ("📞 التواصل", "contact")),
+)
+ADMIN_MENU_ROW = (("⚙️ لوحة الإدارة", "admin_panel"),)
+GAMES_MENU_ROWS = (
+    (("🎲 رمي النرد", "game_dice"), ("🪙 عملة", "game_coin")),
+    (("🔢 تخمين رقم", "game_guess"), ("❌⭕ XO", "game_xo")),
+    (("🎯 حظ", "game_luck"), ("📝 أسئلة", "game_quiz")),
+    (("👥 XO ضد صديق", "game_pvp"),),
+    (("🔙 رجوع", "back_main"),),
+)
+SERVICES_MENU_ROWS = (
+    (("🌍 ترجمة", "service_translate"), ("💰 عملات", "service_currency")),
+    (("🌤 طقس", "service_weather"), ("📝 اقتباس", "service_quote")),
+    (("📊 إحصائيات", "service_stats"), ("🔗 رابط الدعوة", "referral")),
+    (("🔙 رجوع", "back_main"),),
+)
+ADMIN_PANEL_ROWS = (
+    (("📊 إحصائيات", "admin_stats"), ("👥 المستخدمين", "admin_users")),
+    (("👑 المشرفين", "admin_admins"), ("🚫 المحظورين", "admin_banned")),
+    (("🔤 كلمات ممنوعة", "admin_words"), ("📜 سجل", "admin_logs")),
+    (("📢 البث", "admin_broadcast"),),
+    (("🔙 رجوع", "back_main"),),
+)
+XO_GRID_ROWS = (
+    (("1️⃣", "xo_0"), ("2️⃣", "xo_1"), ("3️⃣", "xo_2")),
+    (("4️⃣", "xo_3"), ("5️⃣", "xo_4"), ("6️⃣", "xo_5")),
+    (("7️⃣", "xo_6"), ("8️⃣", "xo_7"), ("9️⃣", "xo_8")),
+)
+XO_LEVEL_NAMES = {'random': "سهل", 'heuristic': "متوسط", 'perfect': "مستحيل"}
+
+def xo_rows(level):
+    return XO_GRID_ROWS + (((f"🧠 {XO_LEVEL_NAMES[level]}", "xo_level"), ("🔚 إنهاء", "xo_end")),)
+
+class Keyboards:
+    # InlineKeyboardMarkup غير قابل للتعديل، فتُبنى مرة واحدة وتُشارك بين كل الطلبات
+    MAIN = build_keyboard(MAIN_MENU_ROWS)
+    MAIN_ADMIN = build_keyboard(MAIN_MENU_ROWS + (ADMIN_MENU_ROW,))
+    GAMES = build_keyboard(GAMES_MENU_ROWS)
+    SERVICES = build_keyboard(SERVICES_MENU_ROWS)
+    ADMIN_PANEL = build_keyboard(ADMIN_PANEL_ROWS)
+    XO = {level: build_keyboard(xo_rows(level)) for level in XO_LEVEL_NAMES}
+    BACK_MAIN = build_keyboard(((("🔙 رجوع", "back_main"),),))
+    BACK_SERVICES = build_keyboard(((("🔙 رجوع", "services_menu"),),))
+    BACK_TODOS = build_keyboard(((("🔙 رجوع", "todos_menu"),),))
+    BACK_ADMIN = build_keyboard(((("🔙 رجوع", "admin_panel"),),))
+    TODOS = build_keyboard(((("➕ إضافة مهمة", "todo_add"), ("🔙 رجوع", "back_main")),))
+    QUOTE = build_keyboard(((("🔄 اقتباس آخر", "service_quote"), ("🔙 رجوع", "services_menu")),))
+    BROADCAST = build_keyboard(((("🔄 تحديث", "admin_broadcast"), ("🔙 رجوع", "admin_panel")),))
+    
+    @classmethod
+    def main_menu(cls, is_admin):
+        return cls.MAIN_ADMIN if is_admin else cls.MAIN
+
+class TextScreen:
+    # القالب يُترجم مرة عند الاستيراد إلى دالة f-string؛ الشاشة بلا حقول تُعاد كما هي دون تنسيق
+    __slots__ = ('template', 'fields', 'keyboard', 'parse_mode', 'render')
+    
+    def __init__(self, template, keyboard=None, parse_mode=ParseMode.MARKDOWN):
+        self.template = template
+        self.keyboard = keyboard
+        self.parse_mode = parse_mode
+        # render هي الدالة المترجمة نفسها: نداء واحد دون طبقة وسيطة
+        self.fields, self.render = self.compile(template)
+    
+    @staticmethod
+    def compile(template):
+        # النصوص الحرفية المتجاورة مع f-string تُدمج عند الترجمة في تعبير واحد دون format() وقت التشغيل
+        fields, parts = [], []
+        for literal, name, spec, conversion in string.Formatter().parse(template):
+            if literal:
+                parts.append(repr(literal))
+            if name is None:
+                continue
+            if not name.isidentifier() or '{' in spec:
+                raise ValueError(f"حقل غير مدعوم في القالب: {name}")
+            if name not in fields:
+                fields.append(name)
+            suffix = (f"!{conversion}" if conversion else '') + (f":{spec}" if spec else '')
+            parts.append('f' + repr('{' + name + suffix + '}'))
+        if not fields:
+            return (), lambda: template
+        source = f"lambda *, {', '.join(fields)}: {' '.join(parts)}"
+        return tuple(fields), eval(compile(source, '<screen>', 'eval'))
+    
+    async def edit(self, query, keyboard=None, **fields):
+        await query.edit_message_text(self.render(**fields), reply_markup=keyboard or self.keyboard, parse_mode=self.parse_mode)
+    
+    async def reply(self, message, keyboard=None, **fields):
+        await message.reply_text(self.render(**fields), reply_markup=keyboard or self.keyboard, parse_mode=self.parse_mode)
+
+class Screens:
+    WELCOME = TextScreen(
+        "✨ أهلاً بك {name} ✨\n\n"
+        "🎁 رصيدك: {points} نقطة\n"
+        "📊 مستواك: {level}\n\n"
+        "اختر من القائمة 👇",
+        parse_mode=None
+    )
+    MAIN_MENU = TextScreen("القائمة الرئيسية:", parse_mode=None)
+    GAMES = TextScreen("🎮 **قائمة الألعاب**", Keyboards.GAMES)
+    SERVICES = TextScreen("📊 **قائمة الخدمات**", Keyboards.SERVICES)
+    ADMIN_PANEL = TextScreen("⚙️ **لوحة الإدارة**", Keyboards.ADMIN_PANEL)
+    XO_TURN = TextScreen("❌⭕ **لعبة XO**\n\nدورك: X\n{board}")
+    HELP = TextScreen("""
+ℹ️ **المساعدة**
+━━━━━━━━━━━━━━━━━━
+
+**الأوامر:**
+/start - الصفحة الرئيسية
+/add [مهمة] - إضافة مهمة
+/done [رقم] - إكمال مهمة
+/remind [نص] [دقائق] - تذكير
+
+**🎮 الألعاب:**
+• نرد: 5-15 نقطة
+• عملة: 3-10 نقاط
+• تخمين: حتى 30 نقطة
+• حظ: 10-30 نقطة
+• XO: 5-60 نقطة
+• XO ضد صديق: 10-60 نقطة
+
+**⭐ النقاط:**
+• 100 نقطة عند التسجيل
+• كل 100 نقطة = مستوى جديد
+• كلما زاد مستواك، زادت مكافآتك
+    """, Keyboards.BACK_MAIN)
+    CONTACT = TextScreen("""
+📞 **التواصل**
+
+للإبلاغ عن مشكلة أو استفسار:
+• البوت: @AlKaref101_bot
+• المطور: @FF2_B(FF2_B)
+
+يرجي نشر البوت مع اصحابك
+    """, Keyboards.BACK_MAIN)
+
+# ==================== بنك الأسئلة ====================
+
+QUIZ_REWARDS = {1: 15, 2: 25, 3: 35}
+
+class QuizBank:
+    # الأسئلة مفهرسة بمعرف ثابت، وما رآه المستخدم بت واحد لكل معرف في عدد صحيح (quiz_seen)
+    def __init__(self, path=QUIZ_FILE):
+        self.path = path
+        self.categories = {}
+        self.questions = {}
+        self._pools = {}
+        self.keyboard = None
+    
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ تعذر تحميل بنك الأسئلة %s: %s", self.path, e)
+            data = {}
+        self.categories = data.get('categories', {})
+        self.questions = {
+            item['id']: (item['category'], item['difficulty'], item['q'], tuple(item['options']), item['answer'])
+            for item in data.get('questions', [])
+        }
+        members = defaultdict(list)
+        for qid, (category, *_) in self.questions.items():
+            members[category].append(qid)
+            members[None].append(qid)
+        # لكل فئة (None = الكل): المعرفات كصف للسحب العشوائي، وقناع بتات للطرح من المرئي
+        self._pools = {category: (tuple(ids), sum(1 << qid for qid in ids)) for category, ids in members.items()}
+        rows = [(("🎲 كل الفئات", "quiz_cat_all"),)]
+        labels = [(label, f"quiz_cat_{key}") for key, label in self.categories.items() if key in members]
+        rows += [tuple(labels[i:i + 2]) for i in range(0, len(labels), 2)]
+        rows.append((("🔙 رجوع", "games_menu"),))
+        self.keyboard = build_keyboard(rows)
+        logger.info("📝 تم تحميل %s سؤال في %s فئة", len(self.questions), len(self.categories))
+    
+    def sample(self, seen, category=None):
+        ids, mask = self._pools.get(category) or self._pools.get(None, ((), 0))
+        if not ids:
+            return None, seen
+        unseen = mask & ~seen
+        if not unseen:
+            # انتهت أسئلة الفئة: تبدأ دورة جديدة دون المساس ببقية الفئات
+            seen &= ~mask
+            unseen = mask
+        if unseen.bit_count() * 4 >= len(ids):
+            # ربع المجموعة على الأقل غير مرئي: أربع محاولات متوقعة على الأكثر
+            while True:
+                qid = random.choice(ids)
+                if unseen >> qid & 1:
+                    break
+        else:
+            qid = random.choice([q for q in ids if unseen >> q & 1])
+        return qid, seen | 1 << qid
+
+quiz_bank = QuizBank()
+quiz_bank.load()
+
+# ==================== ذاكرة مؤقتة للخدمات ====================
+
+class AsyncCache:
+    # LRU محدود الحجم مع TTL؛ الطلبات المتطابقة الجارية تنتظر نفس المهمة بدل تكرار الاستدعاء
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    
+    async def get_or_compute(self, key, compute):
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._data[key]
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            task.add_done_callback(partial(self._done, key))
+        else:
+            self.coalesced += 1
+        # shield: إلغاء أحد المنتظرين لا يلغي الاستدعاء المشترك
+        return await asyncio.shield(task)
+    
+    def _done(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._data[key] = (time.monotonic() + self.ttl, task.result())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+                'coalesced': self.coalesced, 'inflight': len(self._inflight),
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0}
+    
+    def __len__(self):
+        return len(self._data)
+
+# ==================== اتصال HTTP ====================
+
+class HttpSession:
+    # جلسة aiohttp واحدة مشتركة بين الخدمات الخارجية (اتصالات مُعاد استخدامها)
+    def __init__(self, timeout=HTTP_TIMEOUT):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+    
+    def get(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+    
+    async def get_json(self, url, **params):
+        async with self.get().get(url, params=params or None) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+http = HttpSession()
+
+# ==================== أسعار العملات ====================
+
+DEFAULT_RATES = {"USD": 1, "EUR": 0.92, "GBP": 0.79, "EGP": 30.9, "AED": 3.67, "SAR": 3.75}
+
+class RateProvider:
+    # كل مزود يعيد (العملة الأساس، {الرمز: السعر مقابل الأساس})
+    name = 'base'
+    
+    async def fetch(self):
+        raise NotImplementedError
+
+class StaticRateProvider(RateProvider):
+    name = 'static'
+    
+    def __init__(self, rates=DEFAULT_RATES, base='USD'):
+        self.rates = dict(rates)
+        self.base = base
+    
+    async def fetch(self):
+        return self.base, self.rates
+
+class FileRateProvider(RateProvider):
+    # ملف JSON بنفس شكل استجابة open.er-api: {"base_code": "USD", "rates": {...}}
+    name = 'file'
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def _read(self):
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+    
+    async def fetch(self):
+        data = await asyncio.get_running_loop().run_in_executor(None, self._read)
+        return data.get('base_code', 'USD'), data['rates']
+
+class HttpRateProvider(RateProvider):
+    name = 'http'
+    
+    def __init__(self, url=CURRENCY_API_URL, session=http):
+        self.url = url
+        self.session = session
+    
+    async def fetch(self):
+        data = await self.session.get_json(self.url)
+        if data.get('result') != 'success':
+            raise ValueError(data.get('error-type', 'unexpected response'))
+        return data['base_code'], data['rates']
+
+class RateSnapshot:
+    __slots__ = ('base', 'codes', 'index', 'vector', 'fetched_at', 'source')
+    
+    def __init__(self, base, rates, source):
+        self.base = base
+        self.codes = tuple(sorted(rates))
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.vector = np.array([float(rates[code]) for code in self.codes])
+        self.fetched_at = datetime.now()
+        self.source = source
+
+class RateStore:
+    # القراءة دائماً من آخر لقطة ناجحة؛ انتهاء TTL يطلق تحديثاً في الخلفية ولا ينتظره أحد
+    def __init__(self, provider, ttl=CURRENCY_TTL, retry=CURRENCY_RETRY):
+        self.provider = provider
+        self.ttl = ttl
+        self.retry = retry
+        self.snapshot = RateSnapshot('USD', DEFAULT_RATES, 'default')
+        self._expires = 0.0
+        self._task = None
+        self.refreshes = 0
+        self.failures = 0
+    
+    def current(self):
+        if time.monotonic() >= self._expires:
+            self.revalidate()
+        return self.snapshot
+    
+    def revalidate(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.refresh())
+    
+    async def refresh(self):
+        try:
+            base, rates = await self.provider.fetch()
+            snapshot = RateSnapshot(base, rates, self.provider.name)
+            if not np.all(snapshot.vector > 0):
+                raise ValueError("non-positive rate")
+        except Exception as e:
+            self.failures += 1
+            self._expires = time.monotonic() + self.retry
+            logger.warning("⚠️ فشل تحديث أسعار العملات من %s: %s", self.provider.name, e)
+            return False
+        self.snapshot = snapshot
+        self._expires = time.monotonic() + self.ttl
+        self.refreshes += 1
+        return True
+    
+    def convert(self, amount, src, dst):
+        snapshot = self.current()
+        i, j = snapshot.index.get(src), snapshot.index.get(dst)
+        if i is None or j is None:
+            return None
+        return amount / snapshot.vector[i] * snapshot.vector[j]
+    
+    def convert_all(self, amount, src):
+        # تحويل واحد على المتجه كله بدل حلقة على العملات
+        snapshot = self.current()
+        i = snapshot.index.get(src)
+        if i is None:
+            return None, snapshot
+        return snapshot.vector * (amount / snapshot.vector[i]), snapshot
+
+def build_rate_provider():
+    if CURRENCY_FILE:
+        return FileRateProvider(CURRENCY_FILE)
+    if CURRENCY_API_URL:
+        return HttpRateProvider(CURRENCY_API_URL)
+    return StaticRateProvider()
+
+currency_rates = RateStore(build_rate_provider())
+
+def format_currency_table(amount, src, values, snapshot):
+    lines = [f"💰 **{amount:g} {src}**", "━━━━━━━━━━━━━━━━━━"]
+    size = 0
+    for code, value in zip(snapshot.codes, values.tolist()):
+        if code == src:
+            continue
+        line = f"• {code}: {value:,.2f}"
+        size += len(line) + 1
+        if size > 3500:
+            lines.append("…")
+            break
+        lines.append(line)
+    if snapshot.source == 'default':
+        lines.append("\n⚠️ أسعار تقريبية")
+    else:
+        lines.append(f"\n🕐 {snapshot.fetched_at:%Y-%m-%d %H:%M}")
+    return "\n".join(lines)
+
+# ==================== الترجمة ====================
+
+ARABIC_LETTERS = re.compile(r'[\u0600-\u06FF]')
+
+class TranslationBackend:
+    name = 'base'
+    available = True
+    
+    async def translate(self, text, src, dest):
+        raise NotImplementedError
+
+class EchoTranslateBackend(TranslationBackend):
+    # بديل محلي للاختبار وعند غياب googletrans: يعيد النص كما هو، فالخدمة تُعرض كغير متاحة
+    name = 'echo'
+    available = False
+    
+    async def translate(self, text, src, dest):
+        return text
+
+class GoogleTranslateBackend(TranslationBackend):
+    name = 'google'
+    
+    def __init__(self, executor):
+        self.client = GoogleTranslator()
+        self.executor = executor
+    
+    async def translate(self, text, src, dest):
+        src = src if src in GOOGLE_LANGUAGES else 'auto'
+        # googletrans 4.x غير متزامن، والإصدارات الأقدم متزامنة فتعمل في مجمع الخيوط
+        if asyncio.iscoroutinefunction(self.client.translate):
+            result = await self.client.translate(text, src=src, dest=dest)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(self.client.translate, text, src=src, dest=dest))
+        return result.text
+
+class TranslationService:
+    def __init__(self, workers=TRANSLATE_WORKERS, cache_size=TRANSLATE_CACHE_SIZE, ttl=TRANSLATE_CACHE_TTL):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='translate')
+        self.backend = self.build_backend()
+        self.cache = AsyncCache(cache_size, ttl)
+        self._slots = asyncio.Semaphore(workers)
+        self.latency = {}
+        self.errors = 0
+    
+    def build_backend(self):
+        if TRANSLATE_BACKEND == 'google':
+            if GoogleTranslator is not None:
+                return GoogleTranslateBackend(self.executor)
+            logger.warning("⚠️ googletrans غير مثبت، الترجمة تعمل بالبديل المحلي")
+        return EchoTranslateBackend()
+    
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.split()).casefold()
+    
+    LIKELY_FLOOR = 0.1
+    
+    def _detect(self, text):
+        # langdetect متردد في الجمل القصيرة (hello world… = en:0.57): نرجّح لغات الدردشة الشائعة
+        # على تخمين نادر (Good morning friends = da:0.86, en:0.14)، وما عداها يحتاج ثقة كافية
+        try:
+            ranked = detect_language(text)
+        except LangDetectException:
+            return 'auto'
+        for guess in ranked:
+            if guess.lang in TRANSLATE_LIKELY_LANGS and guess.prob >= self.LIKELY_FLOOR:
+                return guess.lang
+        best = ranked[0]
+        return best.lang if best.prob >= TRANSLATE_DETECT_CONFIDENCE else 'auto'
+    
+    async def detect(self, text):
+        # الأحرف العربية تُعرف بتعبير نمطي؛ langdetect (الأبطأ) للباقي فقط
+        letters = [ch for ch in text if ch.isalpha()]
+        if not letters:
+            return 'auto'
+        if len(ARABIC_LETTERS.findall(text)) * 2 > len(letters):
+            return 'ar'
+        if detect_language is None or len(letters) < 3:
+            return 'auto'
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._detect, text)
+    
+    async def translate(self, text, dest='ar'):
+        return await self.cache.get_or_compute((self.normalize(text), dest), partial(self._translate, text, dest))
+    
+    async def _translate(self, text, dest):
+        src = await self.detect(text)
+        if src == dest:
+            return text, src
+        stats = self.latency.setdefault(self.backend.name, [0, 0.0, 0.0])
+        async with self._slots:
+            started = time.perf_counter()
+            try:
+                translated = await self.backend.translate(text, src, dest)
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+        return translated, src
+    
+    @property
+    def available(self):
+        return self.backend.available
+    
+    def stats(self):
+        stats = self.cache.stats()
+        count, total, peak = self.latency.get(self.backend.name, (0, 0.0, 0.0))
+        stats.update(backend=self.backend.name, calls=count, errors=self.errors,
+                     avg_ms=total / count * 1000 if count else 0.0, max_ms=peak * 1000)
+        return stats
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+translator = TranslationService()
+
+# ==================== الطقس ====================
+
+WEATHER_CODES = {
+    0: "☀️ صافٍ", 1: "🌤 صافٍ غالباً", 2: "⛅ غائم جزئياً", 3: "☁️ غائم",
+    45: "🌫 ضباب", 48: "🌫 ضباب متجمد",
+    51: "🌦 رذاذ خفيف", 53: "🌦 رذاذ", 55: "🌦 رذاذ كثيف",
+    61: "🌧 مطر خفيف", 63: "🌧 مطر", 65: "🌧 مطر غزير",
+    71: "🌨 ثلج خفيف", 73: "🌨 ثلج", 75: "🌨 ثلج كثيف",
+    80: "🌦 زخات مطر", 81: "🌧 زخات مطر", 82: "⛈ زخات غزيرة",
+    95: "⛈ عاصفة رعدية", 96: "⛈ عاصفة مع برد", 99: "⛈ عاصفة مع برد",
+}
+
+# (الاسم العربي، الاسم اللاتيني، خط العرض، خط الطول، أسماء بديلة)
+CITIES = (
+    ("القاهرة", "Cairo", 30.04, 31.24, ()),
+    ("الإسكندرية", "Alexandria", 31.20, 29.92, ("اسكندرية",)),
+    ("الجيزة", "Giza", 30.01, 31.21, ()),
+    ("أسوان", "Aswan", 24.09, 32.90, ()),
+    ("الأقصر", "Luxor", 25.69, 32.64, ()),
+    ("المنصورة", "Mansoura", 31.04, 31.38, ()),
+    ("طنطا", "Tanta", 30.79, 31.00, ()),
+    ("بورسعيد", "Port Said", 31.26, 32.30, ("بور سعيد",)),
+    ("السويس", "Suez", 29.97, 32.53, ()),
+    ("الرياض", "Riyadh", 24.71, 46.68, ()),
+    ("جدة", "Jeddah", 21.49, 39.19, ("Jidda",)),
+    ("مكة المكرمة", "Mecca", 21.39, 39.86, ("مكة", "Makkah")),
+    ("المدينة المنورة", "Medina", 24.47, 39.61, ("المدينة", "Madinah")),
+    ("الدمام", "Dammam", 26.43, 50.10, ()),
+    ("دبي", "Dubai", 25.20, 55.27, ()),
+    ("أبوظبي", "Abu Dhabi", 24.45, 54.38, ("أبو ظبي",)),
+    ("الدوحة", "Doha", 25.29, 51.53, ()),
+    ("الكويت", "Kuwait City", 29.38, 47.99, ("Kuwait",)),
+    ("المنامة", "Manama", 26.23, 50.59, ()),
+    ("مسقط", "Muscat", 23.59, 58.41, ()),
+    ("عمّان", "Amman", 31.95, 35.93, ()),
+    ("بيروت", "Beirut", 33.89, 35.50, ()),
+    ("دمشق", "Damascus", 33.51, 36.29, ()),
+    ("بغداد", "Baghdad", 33.31, 44.36, ()),
+    ("القدس", "Jerusalem", 31.77, 35.21, ()),
+    ("غزة", "Gaza", 31.50, 34.47, ()),
+    ("الخرطوم", "Khartoum", 15.50, 32.56, ()),
+    ("طرابلس", "Tripoli", 32.89, 13.19, ()),
+    ("تونس", "Tunis", 36.81, 10.18, ()),
+    ("الجزائر", "Algiers", 36.75, 3.06, ()),
+    ("الرباط", "Rabat", 34.02, -6.84, ()),
+    ("الدار البيضاء", "Casablanca", 33.57, -7.59, ()),
+    ("مراكش", "Marrakesh", 31.63, -7.99, ("Marrakech",)),
+    ("صنعاء", "Sanaa", 15.37, 44.19, ()),
+    ("إسطنبول", "Istanbul", 41.01, 28.98, ("اسطنبول",)),
+    ("لندن", "London", 51.51, -0.13, ()),
+    ("باريس", "Paris", 48.86, 2.35, ()),
+    ("برلين", "Berlin", 52.52, 13.40, ()),
+    ("نيويورك", "New York", 40.71, -74.01, ()),
+    ("طوكيو", "Tokyo", 35.68, 139.69, ()),
+    ("موسكو", "Moscow", 55.76, 37.62, ()),
+)
+
+class City:
+    __slots__ = ('name', 'latin', 'lat', 'lon')
+    
+    def __init__(self, name, latin, lat, lon):
+        self.name = name
+        self.latin = latin
+        self.lat = lat
+        self.lon = lon
+    
+    @property
+    def key(self):
+        return (round(self.lat, 2), round(self.lon, 2))
+
+class CityIndex:
+    # كل الأسماء (عربية، لاتينية، بديلة، وبدون "ال") بعد التوحيد في قاموس واحد، والتقريب بـ difflib
+    def __init__(self, cities=CITIES):
+        self._names = {}
+        for name, latin, lat, lon, aliases in cities:
+            city = City(name, latin, lat, lon)
+            for alias in (name, latin) + aliases:
+                key = self.normalize(alias)
+                self._names[key] = city
+                if key.startswith('ال') and len(key) > 4:
+                    self._names.setdefault(key[2:], city)
+        self._keys = list(self._names)
+    
+    @staticmethod
+    def normalize(name):
+        return ' '.join(normalize_arabic(name).replace('-', ' ').split())
+    
+    def lookup(self, name):
+        key = self.normalize(name)
+        city = self._names.get(key)
+        if city is None:
+            match = difflib.get_close_matches(key, self._keys, n=1, cutoff=0.75)
+            city = self._names[match[0]] if match else None
+        return city
+    
+    def suggestions(self, name, limit=3):
+        matches = difflib.get_close_matches(self.normalize(name), self._keys, n=limit * 3, cutoff=0.5)
+        names = []
+        for key in matches:
+            city = self._names[key].name
+            if city not in names:
+                names.append(city)
+        return names[:limit]
+
+class WeatherProvider:
+    name = 'base'
+    
+    async def current(self, city):
+        raise NotImplementedError
+    
+    async def geocode(self, name):
+        return None
+
+class FakeWeatherProvider(WeatherProvider):
+    # قيم ثابتة محسوبة من الإحداثيات، للاختبار ودون اتصال
+    name = 'fake'
+    
+    async def current(self, city):
+        temperature = round(32 - abs(city.lat) * 0.4, 1)
+        return {'temperature': temperature, 'feels_like': temperature + 1, 'humidity': 40,
+                'wind': 12.0, 'code': 0 if city.lat < 35 else 3}
+
+class OpenMeteoProvider(WeatherProvider):
+    name = 'open-meteo'
+    FIELDS = 'temperature_2m,apparent_temperature,relative_humidity_2m,wind_speed_10m,weather_code'
+    
+    def __init__(self, session=http):
+        self.session = session
+    
+    async def current(self, city):
+        data = await self.session.get_json(WEATHER_API_URL, latitude=city.lat, longitude=city.lon,
+                                           current=self.FIELDS, timezone='auto')
+        current = data['current']
+        return {'temperature': current['temperature_2m'], 'feels_like': current['apparent_temperature'],
+                'humidity': current['relative_humidity_2m'], 'wind': current['wind_speed_10m'],
+                'code': current['weather_code']}
+    
+    async def geocode(self, name):
+        data = await self.session.get_json(WEATHER_GEOCODE_URL, name=name, count=1, language='ar')
+        results = data.get('results')
+        if not results:
+            return None
+        place = results[0]
+        return City(place.get('name', name), place.get('name', name), place['latitude'], place['longitude'])
+
+class WeatherService:
+    def __init__(self, provider, ttl=WEATHER_CACHE_TTL):
+        self.provider = provider
+        self.cities = CityIndex()
+        # نفس المدينة خلال TTL = استدعاء واحد للمزود مهما كان عدد الطالبين
+        self.cache = AsyncCache(512, ttl)
+        self.places = AsyncCache(1024, 86400)
+    
+    async def find_city(self, name):
+        city = self.cities.lookup(name)
+        if city is None:
+            city = await self.places.get_or_compute(CityIndex.normalize(name), partial(self.provider.geocode, name))
+        return city
+    
+    async def report(self, name):
+        city = await self.find_city(name)
+        if city is None:
+            return None, None
+        return city, await self.cache.get_or_compute(city.key, partial(self.provider.current, city))
+    
+    @staticmethod
+    def format(city, report):
+        return (
+            f"🌤 **طقس {escape_markdown(city.name)}**\n"
+            f"━━━━━━━━━━━━━━━━━━\n"
+            f"{WEATHER_CODES.get(report['code'], '🌡')}\n"
+            f"🌡 الحرارة: {report['temperature']:.0f}°C (الإحساس {report['feels_like']:.0f}°C)\n"
+            f"💧 الرطوبة: {report['humidity']}%\n"
+            f"💨 الرياح: {report['wind']:.0f} كم/س"
+        )
+
+weather = WeatherService(FakeWeatherProvider() if WEATHER_BACKEND == 'fake' else OpenMeteoProvider())
+
 # ==================== معالج البدء ====================
 
+@timed("command", "start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if db.is_banned(user.id):
+    if await adb.is_banned(user.id):
         await update.message.reply_text("🚫 أنت محظور من استخدام البوت!")
         return
     
-    db.add_user(user.id, user.first_name, user.username)
-    user_data = db.get_user(user.id)
+    await adb.add_user(user.id, user.first_name, user.username)
+    if context.args and context.args[0].startswith('xo_'):
+        await xo_matches.join(context.bot, update.message, user.id, context.args[0][3:])
+        return
+    user_data = await adb.get_user(user.id)
     points = user_data['points'] if user_data else 100
     level = user_data['level'] if user_data else 1
     
-    keyboard = [
-        [InlineKeyboardButton("🎮 الألعاب", callback_data="games_menu"),
-         InlineKeyboardButton("📊 الخدمات", callback_data="services_menu")],
-        [InlineKeyboardButton("👤 حسابي", callback_data="profile"),
-         InlineKeyboardButton("🏆 المتصدرين", callback_data="leaderboard")],
-        [InlineKeyboardButton("📝 المهام", callback_data="todos_menu"),
-         InlineKeyboardButton("⏰ التذكيرات", callback_data="reminders_menu")],
-        [InlineKeyboardButton("ℹ️ المساعدة", callback_data="help"),
-         InlineKeyboardButton("📞 التواصل", callback_data="contact")]
-    ]
-    
-    if db.is_admin(user.id):
-        keyboard.append([InlineKeyboardButton("⚙️ لوحة الإدارة", callback_data="admin_panel")])
-    
-    await update.message.reply_text(
-        f"✨ أهلاً بك {user.first_name} ✨\n\n"
-        f"🎁 رصيدك: {points} نقطة\n"
-        f"📊 مستواك: {level}\n\n"
-        f"اختر من القائمة 👇",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    keyboard = Keyboards.main_menu(await adb.is_admin(user.id))
+    await Screens.WELCOME.reply(update.message, keyboard, name=user.first_name, points=points, level=level)
 
 # ==================== معالج الأزرار ====================
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+class CallbackRouter:
+    # المسارات الثابتة في قاموس، والمسارات ذات المعاملات (quiz_* / xo_*) في شجرة بادئات
+    def __init__(self, middleware=()):
+        self.middleware = tuple(middleware)
+        self._exact = {}
+        self._trie = {}
+        self.latency = {}
     
-    user_id = update.effective_user.id
+    def route(self, pattern, *middleware, answer=True):
+        def decorator(func):
+            stats = self.latency[pattern] = [0, 0.0, 0.0]
+            handler = self._wrap(func, self.middleware + middleware, answer, stats,
+                                 HANDLER_SECONDS.labels('callback', pattern), HANDLER_ERRORS.labels('callback', pattern))
+            handler.route = pattern
+            if pattern.endswith('*'):
+                node = self._trie
+                for ch in pattern[:-1]:
+                    node = node.setdefault(ch, {})
+                node[None] = handler
+            else:
+                self._exact[pattern] = handler
+            return func
+        return decorator
     
-    if db.is_banned(user_id):
-        await query.edit_message_text("🚫 أنت محظور!")
-        return
+    @staticmethod
+    def _wrap(func, middleware, answer, stats, seconds, errors):
+        # زمن كل مسار: [العدد، المجموع، الأقصى] بالثواني
+        async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = time.perf_counter()
+            try:
+                if answer:
+                    await update.callback_query.answer()
+                for check in middleware:
+                    if not await check(update, context):
+                        # المسارات التي تجيب بنفسها (xo_* / pvp_*) تحتاج إجابة هنا وإلا بقي المؤشر يدور
+                        if not answer:
+                            await update.callback_query.answer()
+                        return ConversationHandler.END
+                result = await func(update, context)
+                return ConversationHandler.END if result is None else result
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                seconds.observe(elapsed)
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+        
+        return handler
     
-    data = query.data
+    def resolve(self, data):
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler
+        # أطول بادئة مطابقة؛ الكلفة تتبع طول البيانات (≤ 64 بايت) لا عدد المسارات
+        node = self._trie
+        for ch in data:
+            node = node.get(ch)
+            if node is None:
+                break
+            handler = node.get(None, handler)
+        return handler
     
-    if data == "back_main":
-        keyboard = [
-            [InlineKeyboardButton("🎮 الألعاب", callback_data="games_menu"),
-             InlineKeyboardButton("📊 الخدمات", callback_data="services_menu")],
-            [InlineKeyboardButton("👤 حسابي", callback_data="profile"),
-             InlineKeyboardButton("🏆 المتصدرين", callback_data="leaderboard")],
-            [InlineKeyboardButton("📝 المهام", callback_data="todos_menu"),
-             InlineKeyboardButton("⏰ التذكيرات", callback_data="reminders_menu")],
-            [InlineKeyboardButton("ℹ️ المساعدة", callback_data="help"),
-             InlineKeyboardButton("📞 التواصل", callback_data="contact")]
-        ]
-        if db.is_admin(user_id):
-            keyboard.append([InlineKeyboardButton("⚙️ لوحة الإدارة", callback_data="admin_panel")])
-        await query.edit_message_text("القائمة الرئيسية:", reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif data == "profile":
-        user = db.get_user(user_id)
-        if user:
-            points = user['points']
-            level = user['level']
-            games = user['total_games'] or 0
-            wins = user['total_wins'] or 0
-            warnings = user['warnings'] or 0
-            emoji = Utilities.get_level_emoji(points)
-            join_date = user['join_date'][:10]
-            last_active = Utilities.time_ago(user['last_active'])
-            
-            text = f"""
+    def handler(self, pattern):
+        # لنقاط دخول ConversationHandler: نفس المعالج مع نفس الوسائط
+        return self.resolve(pattern.rstrip('*'))
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        handler = self.resolve(query.data or '')
+        if handler is None:
+            await query.answer()
+            return ConversationHandler.END
+        return await handler(update, context)
+    
+    def slowest(self, limit=10):
+        rows = [(name, count, total / count, peak) for name, (count, total, peak) in self.latency.items() if count]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+async def not_banned(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await adb.is_banned(update.effective_user.id):
+        await update.callback_query.edit_message_text("🚫 أنت محظور!")
+        return False
+    return True
+
+async def admin_only(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await adb.is_admin(update.effective_user.id):
+        await update.callback_query.edit_message_text("⛔ ليس لديك صلاحية!")
+        return False
+    return True
+
+router = CallbackRouter(middleware=[not_banned])
+
+@router.route("back_main")
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    await Screens.MAIN_MENU.edit(query, Keyboards.main_menu(await adb.is_admin(user_id)))
+
+@router.route("profile")
+async def profile_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    user = await adb.get_user(user_id)
+    if user:
+        points = user['points']
+        level = user['level']
+        games = user['total_games'] or 0
+        wins = user['total_wins'] or 0
+        warnings = user['warnings'] or 0
+        emoji = Utilities.get_level_emoji(points)
+        join_date = user['join_date'][:10]
+        last_active = Utilities.time_ago(activity.last_active(user_id, user['last_active']))
+        
+        text = f"""
 👤 **ملفك الشخصي**
 ━━━━━━━━━━━━━━━━━━
 🆔 المعرف: `{user_id}`
@@ -549,110 +3232,77 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 📅 الانضمام: {join_date}
 🕐 آخر نشاط: {last_active}
-            """
-            keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "leaderboard":
-        top = db.get_top_users(10)
-        text = "🏆 **أفضل المستخدمين**\n━━━━━━━━━━━━━━━━━━\n\n"
-        medals = ["🥇", "🥈", "🥉"]
-        for i, user in enumerate(top):
-            medal = medals[i] if i < 3 else f"{i+1}."
-            emoji = Utilities.get_level_emoji(user['points'])
-            text += f"{medal} {user['first_name']} - {Utilities.format_number(user['points'])} نقطة {emoji}\n"
-        keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "games_menu":
-        keyboard = [
-            [InlineKeyboardButton("🎲 رمي النرد", callback_data="game_dice"),
-             InlineKeyboardButton("🪙 عملة", callback_data="game_coin")],
-            [InlineKeyboardButton("🔢 تخمين رقم", callback_data="game_guess"),
-             InlineKeyboardButton("❌⭕ XO", callback_data="game_xo")],
-            [InlineKeyboardButton("🎯 حظ", callback_data="game_luck"),
-             InlineKeyboardButton("📝 أسئلة", callback_data="game_quiz")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]
-        ]
-        await query.edit_message_text("🎮 **قائمة الألعاب**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "services_menu":
-        keyboard = [
-            [InlineKeyboardButton("🌍 ترجمة", callback_data="service_translate"),
-             InlineKeyboardButton("💰 عملات", callback_data="service_currency")],
-            [InlineKeyboardButton("🌤 طقس", callback_data="service_weather"),
-             InlineKeyboardButton("📝 اقتباس", callback_data="service_quote")],
-            [InlineKeyboardButton("📊 إحصائيات", callback_data="service_stats"),
-             InlineKeyboardButton("🔗 رابط الدعوة", callback_data="referral")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]
-        ]
-        await query.edit_message_text("📊 **قائمة الخدمات**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "todos_menu":
-        todos = db.get_todos(user_id)
-        if not todos:
-            text = "📝 **لا توجد مهام**\n\nلإضافة مهمة:\n/add [المهمة]"
-        else:
-            text = "📝 **مهامي**\n━━━━━━━━━━━━━━━━━━\n\n"
-            for todo in todos:
-                text += f"• {todo['id']}. {todo['task']} (📅 {todo['created_date'][:10]})\n"
-            text += "\nلإكمال مهمة: /done [رقم]"
-        keyboard = [[InlineKeyboardButton("➕ إضافة مهمة", callback_data="todo_add"),
-                     InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "reminders_menu":
-        await query.edit_message_text(
-            "⏰ **التذكيرات**\n\n"
-            "لإضافة تذكير:\n/remind [النص] [الدقائق]\n\n"
-            "مثال: /remind موعد الاجتماع 30",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
-    
-    elif data == "help":
-        text = """
-ℹ️ **المساعدة**
-━━━━━━━━━━━━━━━━━━
+        """
+        await query.edit_message_text(text, reply_markup=Keyboards.BACK_MAIN, parse_mode=ParseMode.MARKDOWN)
 
-**الأوامر:**
-/start - الصفحة الرئيسية
-/add [مهمة] - إضافة مهمة
-/done [رقم] - إكمال مهمة
-/remind [نص] [دقائق] - تذكير
+@router.route("leaderboard")
+async def leaderboard_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    top = await adb.get_top_users(10)
+    text = "🏆 **أفضل المستخدمين**\n━━━━━━━━━━━━━━━━━━\n\n"
+    medals = ["🥇", "🥈", "🥉"]
+    for i, user in enumerate(top):
+        medal = medals[i] if i < 3 else f"{i+1}."
+        emoji = Utilities.get_level_emoji(user['points'])
+        text += f"{medal} {user['first_name']} - {Utilities.format_number(user['points'])} نقطة {emoji}\n"
+    rank = await adb.get_rank(user_id)
+    if rank:
+        text += f"\n📍 ترتيبك: #{rank} من {len(db.leaderboard)}"
+    await query.edit_message_text(text, reply_markup=Keyboards.BACK_MAIN, parse_mode=ParseMode.MARKDOWN)
 
-**🎮 الألعاب:**
-• نرد: 5-15 نقطة
-• عملة: 3-10 نقاط
-• تخمين: حتى 30 نقطة
-• حظ: 10-30 نقطة
-• XO: 20-50 نقطة
+@router.route("games_menu")
+async def games_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await Screens.GAMES.edit(query)
+
+@router.route("services_menu")
+async def services_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await Screens.SERVICES.edit(query)
+
+@router.route("todos_menu")
+async def todos_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    todos = await adb.get_todos(user_id)
+    if not todos:
+        text = "📝 **لا توجد مهام**\n\nلإضافة مهمة:\n/add [المهمة]"
+    else:
+        text = "📝 **مهامي**\n━━━━━━━━━━━━━━━━━━\n\n"
+        for todo in todos:
+            text += f"• {todo['id']}. {todo['task']} (📅 {todo['created_date'][:10]})\n"
+        text += "\nلإكمال مهمة: /done [رقم]"
+    await query.edit_message_text(text, reply_markup=Keyboards.TODOS, parse_mode=ParseMode.MARKDOWN)
 
-**⭐ النقاط:**
-• 100 نقطة عند التسجيل
-• كل 100 نقطة = مستوى جديد
-• كلما زاد مستواك، زادت مكافآتك
-        """
-        keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "contact":
-        text = """
-📞 **التواصل**
+@router.route("reminders_menu")
+async def reminders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(
+        "⏰ **التذكيرات**\n\n"
+        "لإضافة تذكير:\n/remind [النص] [الدقائق]\n\n"
+        "مثال: /remind موعد الاجتماع 30",
+        reply_markup=Keyboards.BACK_MAIN,
+        parse_mode=ParseMode.MARKDOWN
+    )
 
-للإبلاغ عن مشكلة أو استفسار:
-• البوت: @AlKaref101_bot
-• المطور: @FF2_B(FF2_B)
+@router.route("help")
+async def help_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await Screens.HELP.edit(query)
 
-يرجي نشر البوت مع اصحابك
-        """
-        keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "referral":
-        bot_username = (await context.bot.get_me()).username
-        link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        text = f"""
+@router.route("contact")
+async def contact_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await Screens.CONTACT.edit(query)
+
+@router.route("referral")
+async def referral_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    bot_username = (await context.bot.get_me()).username
+    link = f"https://t.me/{bot_username}?start=ref_{user_id}"
+    text = f"""
 🔗 **رابط الدعوة الخاص بك**
 
 {link}
@@ -660,13 +3310,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🎁 كل شخص يسجل عن طريق الرابط:
 • تكسب 50 نقطة
 • هو يكسب 25 نقطة
-        """
-        keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "service_stats":
-        stats = db.get_stats()
-        text = f"""
+    """
+    await query.edit_message_text(text, reply_markup=Keyboards.BACK_MAIN, parse_mode=ParseMode.MARKDOWN)
+
+@router.route("service_stats")
+async def service_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    stats = await adb.get_stats()
+    text = f"""
 📊 **إحصائيات البوت**
 ━━━━━━━━━━━━━━━━━━
 👥 المستخدمين: {stats['total_users']}
@@ -676,15 +3327,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🔤 كلمات ممنوعة: {stats['banned_words']}
 📝 مهام معلقة: {stats['pending_todos']}
 ⏰ تذكيرات: {stats['pending_reminders']}
-        """
-        keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="services_menu")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "service_quote":
-        quote = Utilities.get_random_quote()
-        points = random.randint(2, 5)
-        db.add_points(user_id, points, "قراءة اقتباس")
-        text = f"""
+    """
+    await query.edit_message_text(text, reply_markup=Keyboards.BACK_SERVICES, parse_mode=ParseMode.MARKDOWN)
+
+@router.route("service_quote")
+async def service_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    quote = Utilities.get_random_quote()
+    points = random.randint(2, 5)
+    await adb.add_points(user_id, points, "قراءة اقتباس")
+    text = f"""
 📝 **اقتباس**
 ━━━━━━━━━━━━━━━━━━
 
@@ -693,159 +3346,184 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 — {quote['author']}
 
 🎁 +{points} نقطة
-        """
-        keyboard = [[InlineKeyboardButton("🔄 اقتباس آخر", callback_data="service_quote"),
-                     InlineKeyboardButton("🔙 رجوع", callback_data="services_menu")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "service_weather":
-        await query.edit_message_text(
-            "🌤 **الطقس**\n\nأرسل اسم المدينة:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="services_menu")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        context.user_data['awaiting'] = 'weather'
-    
-    elif data == "service_currency":
-        await query.edit_message_text(
-            "💰 **تحويل العملات**\n\nأرسل: [قيمة] [من] [إلى]\nمثال: 100 USD EUR",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="services_menu")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        context.user_data['awaiting'] = 'currency'
-    
-    elif data == "service_translate":
-        await query.edit_message_text(
-            "🌍 **ترجمة**\n\nأرسل النص للترجمة إلى العربية:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="services_menu")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        context.user_data['awaiting'] = 'translate'
-    
-    elif data == "todo_add":
-        await query.edit_message_text(
-            "📝 **إضافة مهمة**\n\nأرسل المهمة الجديدة:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="todos_menu")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return TODO_ADD
-    
-    elif data == "game_dice":
-        result = random.randint(1, 6)
-        points = random.randint(5, 15)
-        db.add_points(user_id, points, "لعبة نرد")
-        db.update_game_stats(user_id, "dice")
-        await query.edit_message_text(f"🎲 **النتيجة:** {result}\n🎁 **+{points} نقطة**", parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "game_coin":
-        result = random.choice(["صورة", "كتابة"])
-        points = random.randint(3, 10)
-        db.add_points(user_id, points, "لعبة عملة")
-        db.update_game_stats(user_id, "coin")
-        await query.edit_message_text(f"🪙 **النتيجة:** {result}\n🎁 **+{points} نقطة**", parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "game_luck":
-        numbers = [random.randint(1, 50) for _ in range(3)]
-        total = sum(numbers)
-        if total > 100:
-            points = 30
-            msg = "🎉 حظك العالي!"
-        elif total > 70:
-            points = 20
-            msg = "👍 حظك كويس"
-        else:
-            points = 10
-            msg = "👌 حظك عادي"
-        db.add_points(user_id, points, "لعبة حظ")
-        db.update_game_stats(user_id, "luck")
-        await query.edit_message_text(
-            f"🎯 **لعبة الحظ**\n\nأرقامك: {numbers[0]} - {numbers[1]} - {numbers[2]}\nالمجموع: {total}\n{msg}\n🎁 +{points} نقطة",
-            parse_mode=ParseMode.MARKDOWN
-        )
-    
-    elif data == "game_guess":
-        number = random.randint(1, 20)
-        context.user_data['guess_number'] = number
-        context.user_data['guess_attempts'] = 0
-        await query.edit_message_text(
-            "🔢 **تخمين الرقم**\n\nرقم بين 1 و 20\nأرسل تخمينك:",
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return GUESS_GAME
-    
-    elif data == "game_xo":
-        board = [' '] * 9
-        context.user_data['xo_board'] = board
-        context.user_data['xo_turn'] = 'X'
-        context.user_data['xo_moves'] = 0
-        keyboard = [
-            [InlineKeyboardButton("1️⃣", callback_data="xo_0"), InlineKeyboardButton("2️⃣", callback_data="xo_1"), InlineKeyboardButton("3️⃣", callback_data="xo_2")],
-            [InlineKeyboardButton("4️⃣", callback_data="xo_3"), InlineKeyboardButton("5️⃣", callback_data="xo_4"), InlineKeyboardButton("6️⃣", callback_data="xo_5")],
-            [InlineKeyboardButton("7️⃣", callback_data="xo_6"), InlineKeyboardButton("8️⃣", callback_data="xo_7"), InlineKeyboardButton("9️⃣", callback_data="xo_8")],
-            [InlineKeyboardButton("🔚 إنهاء", callback_data="xo_end")]
-        ]
-        await query.edit_message_text(
-            f"❌⭕ **لعبة XO**\n\nدورك: X\n{format_xo_board(board)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return XO_GAME
-    
-    elif data == "game_quiz":
-        questions = [
-            {"q": "ما عاصمة مصر؟", "a": "القاهرة", "options": ["القاهرة", "الإسكندرية", "الجيزة", "أسوان"]},
-            {"q": "كم عدد ألوان قوس قزح؟", "a": "7", "options": ["5", "6", "7", "8"]},
-            {"q": "ما أكبر محيط في العالم؟", "a": "الهادئ", "options": ["الأطلسي", "الهادئ", "الهندي", "المتجمد"]},
-            {"q": "في أي سنة هبط الإنسان على القمر؟", "a": "1969", "options": ["1965", "1969", "1972", "1975"]},
-            {"q": "ما أطول نهر في العالم؟", "a": "النيل", "options": ["الأمازون", "النيل", "المسيسيبي", "اليانغتسي"]},
-        ]
-        q = random.choice(questions)
-        context.user_data['quiz'] = q
-        keyboard = [
-            [InlineKeyboardButton(q['options'][0], callback_data=f"quiz_{q['options'][0]}"),
-             InlineKeyboardButton(q['options'][1], callback_data=f"quiz_{q['options'][1]}")],
-            [InlineKeyboardButton(q['options'][2], callback_data=f"quiz_{q['options'][2]}"),
-             InlineKeyboardButton(q['options'][3], callback_data=f"quiz_{q['options'][3]}")],
-            [InlineKeyboardButton("❌ تخطي", callback_data="games_menu")]
-        ]
-        await query.edit_message_text(f"📝 **سؤال**\n\n{q['q']}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data.startswith("quiz_"):
-        answer = data[5:]
-        correct = context.user_data.get('quiz', {}).get('a')
-        if answer == correct:
-            points = 25
-            msg = f"✅ إجابة صحيحة!\n🎁 +{points} نقطة"
-            db.add_points(user_id, points, "فوز في الأسئلة")
-            db.update_game_stats(user_id, "quiz", won=True)
-        else:
-            points = 5
-            msg = f"❌ إجابة خاطئة! الإجابة الصحيحة: {correct}\n🎁 +{points} نقطة"
-            db.add_points(user_id, points, "مشاركة في الأسئلة")
-            db.update_game_stats(user_id, "quiz")
-        keyboard = [[InlineKeyboardButton("🔄 سؤال آخر", callback_data="game_quiz")]]
-        await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "admin_panel":
-        if not db.is_admin(user_id):
-            await query.edit_message_text("⛔ ليس لديك صلاحية!")
-            return
-        keyboard = [
-            [InlineKeyboardButton("📊 إحصائيات", callback_data="admin_stats"),
-             InlineKeyboardButton("👥 المستخدمين", callback_data="admin_users")],
-            [InlineKeyboardButton("👑 المشرفين", callback_data="admin_admins"),
-             InlineKeyboardButton("🚫 المحظورين", callback_data="admin_banned")],
-            [InlineKeyboardButton("🔤 كلمات ممنوعة", callback_data="admin_words"),
-             InlineKeyboardButton("📜 سجل", callback_data="admin_logs")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]
-        ]
-        await query.edit_message_text("⚙️ **لوحة الإدارة**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    elif data == "admin_stats":
-        if not db.is_admin(user_id):
-            return
-        stats = db.get_stats()
-        text = f"""
+    """
+    await query.edit_message_text(text, reply_markup=Keyboards.QUOTE, parse_mode=ParseMode.MARKDOWN)
+
+@router.route("service_weather")
+async def service_weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(
+        "🌤 **الطقس**\n\nأرسل اسم المدينة:",
+        reply_markup=Keyboards.BACK_SERVICES,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    context.user_data['awaiting'] = 'weather'
+
+@router.route("service_currency")
+async def service_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(
+        "💰 **تحويل العملات**\n\nأرسل: [قيمة] [من] [إلى]\nمثال: 100 USD EUR\nولكل العملات: 100 USD all",
+        reply_markup=Keyboards.BACK_SERVICES,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    context.user_data['awaiting'] = 'currency'
+
+@router.route("service_translate")
+async def service_translate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not translator.available:
+        await query.edit_message_text("🌍 الترجمة غير متاحة حالياً", reply_markup=Keyboards.BACK_SERVICES)
+        return
+    await query.edit_message_text(
+        "🌍 **ترجمة**\n\nأرسل النص للترجمة إلى العربية:",
+        reply_markup=Keyboards.BACK_SERVICES,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    context.user_data['awaiting'] = 'translate'
+
+@router.route("todo_add")
+async def todo_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(
+        "📝 **إضافة مهمة**\n\nأرسل المهمة الجديدة:",
+        reply_markup=Keyboards.BACK_TODOS,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return TODO_ADD
+
+@router.route("game_dice")
+async def game_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    result = random.randint(1, 6)
+    points = random.randint(5, 15)
+    await adb.add_points(user_id, points, "لعبة نرد")
+    await adb.update_game_stats(user_id, "dice")
+    await query.edit_message_text(f"🎲 **النتيجة:** {result}\n🎁 **+{points} نقطة**", parse_mode=ParseMode.MARKDOWN)
+
+@router.route("game_coin")
+async def game_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    result = random.choice(["صورة", "كتابة"])
+    points = random.randint(3, 10)
+    await adb.add_points(user_id, points, "لعبة عملة")
+    await adb.update_game_stats(user_id, "coin")
+    await query.edit_message_text(f"🪙 **النتيجة:** {result}\n🎁 **+{points} نقطة**", parse_mode=ParseMode.MARKDOWN)
+
+@router.route("game_luck")
+async def game_luck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    numbers = [random.randint(1, 50) for _ in range(3)]
+    total = sum(numbers)
+    if total > 100:
+        points = 30
+        msg = "🎉 حظك العالي!"
+    elif total > 70:
+        points = 20
+        msg = "👍 حظك كويس"
+    else:
+        points = 10
+        msg = "👌 حظك عادي"
+    await adb.add_points(user_id, points, "لعبة حظ")
+    await adb.update_game_stats(user_id, "luck")
+    await query.edit_message_text(
+        f"🎯 **لعبة الحظ**\n\nأرقامك: {numbers[0]} - {numbers[1]} - {numbers[2]}\nالمجموع: {total}\n{msg}\n🎁 +{points} نقطة",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+@router.route("game_guess")
+async def game_guess(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    number = random.randint(1, 20)
+    context.user_data['guess_number'] = number
+    context.user_data['guess_attempts'] = 0
+    await query.edit_message_text(
+        "🔢 **تخمين الرقم**\n\nرقم بين 1 و 20\nأرسل تخمينك:",
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return GUESS_GAME
+
+@router.route("game_xo")
+async def game_xo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    board = [' '] * 9
+    context.user_data['xo_board'] = board
+    context.user_data['xo_turn'] = 'X'
+    context.user_data['xo_moves'] = 0
+    level = context.user_data.setdefault('xo_level', 'heuristic')
+    await Screens.XO_TURN.edit(query, Keyboards.XO[level], board=format_xo_board(board))
+    return XO_GAME
+
+@router.route("game_quiz")
+async def game_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text("📝 **الأسئلة**\n\nاختر الفئة:", reply_markup=quiz_bank.keyboard, parse_mode=ParseMode.MARKDOWN)
+
+async def ask_quiz(query, context, key):
+    qid, seen = quiz_bank.sample(context.user_data.get('quiz_seen', 0), None if key == 'all' else key)
+    if qid is None:
+        await query.edit_message_text("📝 لا توجد أسئلة حالياً", reply_markup=Keyboards.BACK_MAIN)
+        return
+    context.user_data['quiz_seen'] = seen
+    context.user_data['quiz'] = qid
+    category, difficulty, text, options, _ = quiz_bank.questions[qid]
+    buttons = [InlineKeyboardButton(options[i], callback_data=f"quiz_{qid}_{i}")
+               for i in random.sample(range(len(options)), len(options))]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton("⏭ تخطي", callback_data=f"quiz_cat_{key}"),
+                     InlineKeyboardButton("🗂 الفئات", callback_data="game_quiz")])
+    label = quiz_bank.categories.get(category, category)
+    await query.edit_message_text(f"📝 **سؤال** | {label} | {'⭐' * difficulty}\n\n{text}",
+                                  reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+
+@router.route("quiz_*")
+async def quiz_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    head, _, tail = query.data[5:].partition('_')
+    if head == 'cat':
+        context.user_data['quiz_cat'] = tail
+        await ask_quiz(query, context, tail)
+        return
+    key = context.user_data.get('quiz_cat', 'all')
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 سؤال آخر", callback_data=f"quiz_cat_{key}"),
+                                      InlineKeyboardButton("🗂 الفئات", callback_data="game_quiz")]])
+    try:
+        qid, choice = int(head), int(tail)
+    except ValueError:
+        qid = choice = None
+    if context.user_data.get('quiz') != qid or qid not in quiz_bank.questions:
+        await query.edit_message_text("⌛ انتهى هذا السؤال", reply_markup=keyboard)
+        return
+    del context.user_data['quiz']
+    _, difficulty, _, options, answer = quiz_bank.questions[qid]
+    if choice == answer:
+        points = QUIZ_REWARDS.get(difficulty, 25)
+        msg = f"✅ إجابة صحيحة!\n🎁 +{points} نقطة"
+        await adb.add_points(user_id, points, "فوز في الأسئلة")
+        await adb.update_game_stats(user_id, "quiz", won=True)
+    else:
+        points = 5
+        msg = f"❌ إجابة خاطئة! الإجابة الصحيحة: {options[answer]}\n🎁 +{points} نقطة"
+        await adb.add_points(user_id, points, "مشاركة في الأسئلة")
+        await adb.update_game_stats(user_id, "quiz")
+    await query.edit_message_text(msg, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+
+@router.route("admin_panel", admin_only)
+async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await Screens.ADMIN_PANEL.edit(query)
+
+@router.route("admin_stats", admin_only)
+async def admin_stats_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    stats = await adb.get_stats()
+    pool = db.pool_stats()
+    tr = translator.stats()
+    text = f"""
 📊 **إحصائيات متقدمة**
 ━━━━━━━━━━━━━━━━━━
 👥 المستخدمين: {stats['total_users']}
@@ -856,11 +3534,47 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📝 مهام: {stats['pending_todos']}
 ⏰ تذكيرات: {stats['pending_reminders']}
 💾 قاعدة البيانات: {os.path.getsize(DATABASE_NAME)/1024:.1f} KB
-        """
-        keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-    
-    return ConversationHandler.END
+🔌 انتظار الاتصال: {pool['wait_avg_ms']:.2f} ms (أقصى {pool['wait_max_ms']:.1f} ms)
+🌍 الترجمة ({tr['backend']}): {tr['calls']} طلب، {tr['avg_ms']:.0f} ms، من الذاكرة {tr['hit_rate']:.0%}
+    """
+    await query.edit_message_text(text, reply_markup=Keyboards.BACK_ADMIN, parse_mode=ParseMode.MARKDOWN)
+
+@router.route("admin_words", admin_only)
+async def admin_words_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    text = f"🔤 **الكلمات الممنوعة**\n━━━━━━━━━━━━━━━━━━\n📚 العدد: {len(word_filter)}\n🔍 رسائل مفحوصة: {word_filter.checked}\n\n"
+    for word, count in word_filter.hits.most_common(10):
+        text += f"• {word}: {count}\n"
+    text += "\nلإضافة كلمة: /addword [الكلمة]"
+    await query.edit_message_text(text, reply_markup=Keyboards.BACK_ADMIN)
+
+@router.route("admin_logs", admin_only)
+async def admin_logs_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    profiler = db.pool.profiler
+    if profiler is None:
+        text = "📜 **سجل الاستعلامات**\n━━━━━━━━━━━━━━━━━━\nالتسجيل معطل، شغّل البوت مع `DB_PROFILE=1`"
+        await query.edit_message_text(text, reply_markup=Keyboards.BACK_ADMIN, parse_mode=ParseMode.MARKDOWN)
+        return
+    # القوالب تحتوي رموز Markdown مثل * و _ فتُرسل كنص عادي
+    text = f"📜 أثقل الاستعلامات\n━━━━━━━━━━━━━━━━━━\n🔢 استعلامات: {profiler.calls}\n🐢 أبطأ من {profiler.slow_threshold * 1000:g} ms: {profiler.slow_count()}\n\n"
+    for row in profiler.top(8):
+        sql = row['template'] if len(row['template']) <= 90 else row['template'][:87] + '...'
+        text += f"• {row['total_ms']:.0f} ms | {row['count']}× | p99 {row['p99_ms']:.1f} ms | {row['rows']} صف\n{sql}\n\n"
+    for stamp, template, elapsed in list(profiler.slow_log)[-3:]:
+        text += f"🐢 {stamp:%H:%M:%S} {elapsed * 1000:.0f} ms: {template[:60]}\n"
+    await query.edit_message_text(text[:4000], reply_markup=Keyboards.BACK_ADMIN)
+
+@router.route("admin_broadcast", admin_only)
+async def admin_broadcast_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    latest = await adb.get_broadcasts(limit=1)
+    if not latest:
+        text = "📢 **البث**\n\nلا يوجد بث سابق\n\nللإرسال لكل المستخدمين:\n/broadcast [الرسالة]"
+    else:
+        row = broadcasts.progress(latest[0]['id']) or latest[0]
+        text = broadcasts.format_progress(row) + "\n\nللإرسال: /broadcast [الرسالة]"
+    await query.edit_message_text(text, reply_markup=Keyboards.BROADCAST, parse_mode=ParseMode.MARKDOWN)
 
 # ==================== لعبة XO ====================
 
@@ -873,118 +3587,361 @@ def format_xo_board(board):
  {board[6]} │ {board[7]} │ {board[8]} 
     """
 
-def check_winner(board):
-    lines = [
-        [0,1,2], [3,4,5], [6,7,8],
-        [0,3,6], [1,4,7], [2,5,8],
-        [0,4,8], [2,4,6]
-    ]
-    for line in lines:
-        if board[line[0]] == board[line[1]] == board[line[2]] != ' ':
-            return board[line[0]]
-    if ' ' not in board:
-        return 'draw'
-    return None
-
-def get_computer_move(board):
-    for i in range(9):
-        if board[i] == ' ':
-            board[i] = 'O'
-            if check_winner(board) == 'O':
-                board[i] = ' '
-                return i
-            board[i] = ' '
-    for i in range(9):
-        if board[i] == ' ':
-            board[i] = 'X'
-            if check_winner(board) == 'X':
-                board[i] = ' '
-                return i
-            board[i] = ' '
-    if board[4] == ' ':
-        return 4
-    corners = [0,2,6,8]
-    random.shuffle(corners)
-    for c in corners:
-        if board[c] == ' ':
-            return c
-    available = [i for i in range(9) if board[i] == ' ']
-    return random.choice(available) if available else None
+class XOEngine:
+    # اللوحة عددان من 9 بتات (خانات X وخانات O)، والجدول يغطي كل المواقع الممكنة
+    LINES = (0o007, 0o070, 0o700, 0o111, 0o222, 0o444, 0o421, 0o124)
+    FULL = 0o777
+    CENTER = 4
+    CORNERS = (0, 2, 6, 8)
+    LEVELS = ('random', 'heuristic', 'perfect')
+    
+    def __init__(self):
+        self.wins = tuple(any(mask & line == line for line in self.LINES) for mask in range(512))
+        self.empty = tuple(tuple(i for i in range(9) if not mask >> i & 1) for mask in range(512))
+        # (لاعب الدور، الخصم) -> (القيمة، أفضل الحركات)؛ نفس الجدول يخدم X و O
+        self.table = {}
+        self._solve(0, 0)
+    
+    @staticmethod
+    def encode(board):
+        x = o = 0
+        for i, cell in enumerate(board):
+            if cell == 'X':
+                x |= 1 << i
+            elif cell == 'O':
+                o |= 1 << i
+        return x, o
+    
+    def _solve(self, me, other):
+        cached = self.table.get((me, other))
+        if cached:
+            return cached[0]
+        best, moves = -10, []
+        for i in self.empty[me | other]:
+            mine = me | 1 << i
+            if self.wins[mine]:
+                # الفوز الأسرع أعلى قيمة، والخسارة الأبطأ أقل سوءاً
+                score = 1 + len(self.empty[mine | other])
+            elif mine | other == self.FULL:
+                score = 0
+            else:
+                score = -self._solve(other, mine)
+            if score > best:
+                best, moves = score, [i]
+            elif score == best:
+                moves.append(i)
+        self.table[(me, other)] = (best, tuple(moves))
+        return best
+    
+    def outcome(self, x, o):
+        if self.wins[x]:
+            return 'X'
+        if self.wins[o]:
+            return 'O'
+        if x | o == self.FULL:
+            return 'draw'
+        return None
+    
+    def move(self, me, other, level='perfect'):
+        empty = self.empty[me | other]
+        if not empty:
+            return None
+        if level == 'perfect':
+            return random.choice(self.table[(me, other)][1])
+        if level == 'heuristic':
+            for i in empty:
+                if self.wins[me | 1 << i]:
+                    return i
+            for i in empty:
+                if self.wins[other | 1 << i]:
+                    return i
+            if self.CENTER in empty:
+                return self.CENTER
+            corners = [c for c in self.CORNERS if c in empty]
+            if corners:
+                return random.choice(corners)
+        return random.choice(empty)
+
+xo_engine = XOEngine()
+
+XO_REWARDS = {
+    'random': {'X': 20, 'O': 5, 'draw': 10},
+    'heuristic': {'X': 50, 'O': 25, 'draw': 30},
+    'perfect': {'X': 60, 'O': 25, 'draw': 40},
+}
 
+async def finish_xo(query, user_id, board, winner, level):
+    points = XO_REWARDS[level][winner]
+    if winner == 'X':
+        await adb.add_points(user_id, points, "فوز في XO")
+        await adb.update_game_stats(user_id, "xo", won=True)
+        msg = f"🎉 فزت! +{points} نقطة"
+    elif winner == 'O':
+        await adb.add_points(user_id, points, "مشاركة في XO")
+        await adb.update_game_stats(user_id, "xo")
+        msg = f"😔 الكمبيوتر فاز! +{points} نقطة"
+    else:
+        await adb.add_points(user_id, points, "تعادل في XO")
+        await adb.update_game_stats(user_id, "xo")
+        msg = f"🤝 تعادل! +{points} نقطة"
+    await query.edit_message_text(f"{msg}\n\n{format_xo_board(board)}", parse_mode=ParseMode.MARKDOWN)
+    return ConversationHandler.END
+
+@router.route("xo_*", answer=False)
 async def xo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
     data = query.data
+    level = context.user_data.get('xo_level', 'heuristic')
     
     if data == "xo_end":
+        await query.answer()
         await query.edit_message_text("❌ تم إنهاء اللعبة")
         return ConversationHandler.END
     
-    if data.startswith("xo_"):
-        pos = int(data.split('_')[1])
-        board = context.user_data.get('xo_board', [' ']*9)
-        
-        if board[pos] != ' ':
-            await query.answer("هذا المكان مشغول!", show_alert=True)
+    board = context.user_data.get('xo_board', [' ']*9)
+    
+    if data == "xo_level":
+        if context.user_data.get('xo_moves'):
+            await query.answer("⚠️ غيّر الصعوبة قبل أول حركة", show_alert=True)
             return XO_GAME
+        levels = XOEngine.LEVELS
+        level = levels[(levels.index(level) + 1) % len(levels)]
+        context.user_data['xo_level'] = level
+        await query.answer(f"🧠 الصعوبة: {XO_LEVEL_NAMES[level]}")
+        await Screens.XO_TURN.edit(query, Keyboards.XO[level], board=format_xo_board(board))
+        return XO_GAME
+    
+    pos = int(data.split('_')[1])
+    x, o = XOEngine.encode(board)
+    if (x | o) >> pos & 1:
+        await query.answer("هذا المكان مشغول!", show_alert=True)
+        return XO_GAME
+    await query.answer()
+    
+    board[pos] = 'X'
+    x |= 1 << pos
+    context.user_data['xo_moves'] = context.user_data.get('xo_moves', 0) + 1
+    
+    winner = xo_engine.outcome(x, o)
+    if winner:
+        return await finish_xo(query, user_id, board, winner, level)
+    
+    comp = xo_engine.move(o, x, level)
+    board[comp] = 'O'
+    winner = xo_engine.outcome(x, o | 1 << comp)
+    if winner:
+        return await finish_xo(query, user_id, board, winner, level)
+    
+    await Screens.XO_TURN.edit(query, Keyboards.XO[level], board=format_xo_board(board))
+    return XO_GAME
+
+# ==================== XO ضد صديق ====================
+
+XO_MARKS = {'X': "❌", 'O': "⭕"}
+XO_PVP_REWARDS = {'win': 60, 'loss': 10, 'draw': 30}
+XO_PVP_CELLS = frozenset(str(pos) for pos in range(9))
+
+class XOMatches:
+    # المباريات المفتوحة (انتظار / جارية) في الذاكرة، والجدول xo_games هو المرجع عند التعارض
+    def __init__(self, adb):
+        self.adb = adb
+        self.active = {}
+    
+    async def load(self):
+        self.active = {row['game_id']: row for row in await self.adb.get_open_xo_games()}
+    
+    def player_name(self, user_id):
+        name = db.leaderboard.name(user_id) or str(user_id)
+        return escape_markdown(name)
+    
+    def render(self, game):
+        board = game['board']
+        x_name, o_name = self.player_name(game['player_x']), self.player_name(game['player_o'])
+        if game['status'] == 'active':
+            mark = 'X' if game['current_turn'] == game['player_x'] else 'O'
+            line = f"الدور: {XO_MARKS[mark]} {x_name if mark == 'X' else o_name}"
+        elif game['winner']:
+            line = f"🏆 الفائز: {x_name if game['winner'] == game['player_x'] else o_name}"
+        else:
+            line = "🤝 تعادل!"
+        text = f"❌⭕ **XO ضد صديق**\n\n❌ {x_name} ضد ⭕ {o_name}\n{line}\n{format_xo_board(board)}"
+        if game['status'] != 'active':
+            return text, None
+        prefix = f"pvp_{game['game_id']}_{game['version']}_"
+        keyboard = [
+            [InlineKeyboardButton(XO_MARKS.get(board[int(data[3:])], label), callback_data=prefix + data[3:])
+             for label, data in row]
+            for row in XO_GRID_ROWS
+        ]
+        keyboard.append([InlineKeyboardButton("🏳️ انسحاب", callback_data=prefix + "r")])
+        return text, InlineKeyboardMarkup(keyboard)
+    
+    async def publish(self, bot, game):
+        text, keyboard = self.render(game)
+        edits = [
+            bot.edit_message_text(chat_id=player, message_id=message_id, text=text,
+                                  reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+            for player, message_id in ((game['player_x'], game['x_message_id']), (game['player_o'], game['o_message_id']))
+            if message_id
+        ]
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception) and not isinstance(result, BadRequest):
+                logger.warning("⚠️ تعذر تحديث لوحة XO %s: %s", game['game_id'], result)
+    
+    async def create(self, bot, query, user_id):
+        game = await self.adb.create_xo_game(secrets.token_hex(4), user_id, query.message.message_id)
+        self.active[game['game_id']] = game
+        link = f"https://t.me/{bot.username}?start=xo_{game['game_id']}"
+        share = "https://t.me/share/url?" + urlencode({'url': link, 'text': "تحداني في XO ❌⭕"})
+        keyboard = [[InlineKeyboardButton("📨 إرسال الدعوة", url=share)],
+                    [InlineKeyboardButton("❌ إلغاء", callback_data=f"pvp_{game['game_id']}_0_c")]]
+        await query.edit_message_text(
+            f"👥 XO ضد صديق\n\nأرسل الرابط لصديقك، وتبدأ المباراة عند دخوله:\n{link}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def join(self, bot, message, user_id, game_id):
+        game = self.active.get(game_id)
+        if game is None or game['status'] != 'waiting':
+            await message.reply_text("⌛ الدعوة غير صالحة أو انتهت")
+            return
+        if game['player_x'] == user_id:
+            await message.reply_text("⚠️ لا يمكنك اللعب ضد نفسك")
+            return
+        row = await self.adb.join_xo_game(game_id, user_id)
+        if row is None:
+            await message.reply_text("⌛ الدعوة غير صالحة أو انتهت")
+            return
+        game.update(row)
+        text, keyboard = self.render(game)
+        sent = await message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+        await self.publish(bot, game)
+        game['o_message_id'] = sent.message_id
+        await self.adb.set_xo_message(game_id, sent.message_id)
+    
+    async def play(self, bot, user_id, game_id, version, action):
+        # تعيد نص التنبيه عند رفض الحركة، أو None عند قبولها
+        game = self.active.get(game_id)
+        if game is None:
+            return "⌛ انتهت هذه المباراة"
+        if user_id not in (game['player_x'], game['player_o']):
+            return "👀 هذه المباراة ليست لك"
+        if version != game['version']:
+            return "⏳ اللوحة تغيرت، حاول مرة أخرى"
         
-        board[pos] = 'X'
-        context.user_data['xo_moves'] += 1
+        if action == 'c':
+            if game['status'] != 'waiting' or user_id != game['player_x']:
+                return "⚠️ لا يمكن الإلغاء الآن"
+            if not await self.adb.update_xo_game(game_id, version, game['board'], None, 'cancelled'):
+                return "⏳ اللوحة تغيرت، حاول مرة أخرى"
+            self.active.pop(game_id, None)
+            await bot.edit_message_text(chat_id=user_id, message_id=game['x_message_id'], text="❌ تم إلغاء الدعوة")
+            return None
         
-        winner = check_winner(board)
-        if winner:
-            if winner == 'X':
-                points = 50
-                db.add_points(user_id, points, "فوز في XO")
-                db.update_game_stats(user_id, "xo", won=True)
-                msg = f"🎉 فزت! +{points} نقطة"
-            elif winner == 'O':
-                points = 25
-                db.add_points(user_id, points, "مشاركة في XO")
-                db.update_game_stats(user_id, "xo")
-                msg = f"😔 الكمبيوتر فاز! +{points} نقطة"
+        if game['status'] != 'active':
+            return "⌛ بانتظار انضمام الخصم"
+        other = game['player_o'] if user_id == game['player_x'] else game['player_x']
+        board = game['board']
+        if action == 'r':
+            status, turn, winner = 'finished', None, other
+        else:
+            if action not in XO_PVP_CELLS:
+                return "⚠️ حركة غير صالحة"
+            if game['current_turn'] != user_id:
+                return "⏳ ليس دورك"
+            pos = int(action)
+            if board[pos] != ' ':
+                return "هذا المكان مشغول!"
+            mark = 'X' if user_id == game['player_x'] else 'O'
+            board = board[:pos] + mark + board[pos + 1:]
+            result = xo_engine.outcome(*XOEngine.encode(board))
+            if result is None:
+                status, turn, winner = 'active', other, None
             else:
-                points = 30
-                db.add_points(user_id, points, "تعادل في XO")
-                db.update_game_stats(user_id, "xo")
-                msg = f"🤝 تعادل! +{points} نقطة"
-            await query.edit_message_text(f"{msg}\n\n{format_xo_board(board)}", parse_mode=ParseMode.MARKDOWN)
-            return ConversationHandler.END
-        
-        comp = get_computer_move(board)
-        if comp is not None:
-            board[comp] = 'O'
-            winner = check_winner(board)
-            if winner:
-                if winner == 'O':
-                    points = 25
-                    db.add_points(user_id, points, "مشاركة في XO")
-                    db.update_game_stats(user_id, "xo")
-                    msg = f"😔 الكمبيوتر فاز! +{points} نقطة"
-                else:
-                    points = 30
-                    db.add_points(user_id, points, "تعادل في XO")
-                    db.update_game_stats(user_id, "xo")
-                    msg = f"🤝 تعادل! +{points} نقطة"
-                await query.edit_message_text(f"{msg}\n\n{format_xo_board(board)}", parse_mode=ParseMode.MARKDOWN)
-                return ConversationHandler.END
+                status, turn, winner = 'finished', None, (user_id if result == mark else None)
         
-        keyboard = [
-            [InlineKeyboardButton("1️⃣", callback_data="xo_0"), InlineKeyboardButton("2️⃣", callback_data="xo_1"), InlineKeyboardButton("3️⃣", callback_data="xo_2")],
-            [InlineKeyboardButton("4️⃣", callback_data="xo_3"), InlineKeyboardButton("5️⃣", callback_data="xo_4"), InlineKeyboardButton("6️⃣", callback_data="xo_5")],
-            [InlineKeyboardButton("7️⃣", callback_data="xo_6"), InlineKeyboardButton("8️⃣", callback_data="xo_7"), InlineKeyboardButton("9️⃣", callback_data="xo_8")],
-            [InlineKeyboardButton("🔚 إنهاء", callback_data="xo_end")]
+        if not await self.adb.update_xo_game(game_id, version, board, turn, status, winner):
+            return "⏳ اللوحة تغيرت، حاول مرة أخرى"
+        game.update(board=board, current_turn=turn, status=status, winner=winner, version=version + 1)
+        if status == 'finished':
+            self.active.pop(game_id, None)
+            await self.payout(game, resigned=action == 'r')
+        await self.publish(bot, game)
+        return None
+    
+    async def payout(self, game, resigned=False):
+        players = (game['player_x'], game['player_o'])
+        if game['winner'] is None:
+            await self.adb.add_points_bulk([(p, XO_PVP_REWARDS['draw']) for p in players], "تعادل في XO ضد صديق")
+        else:
+            loser = players[1] if game['winner'] == players[0] else players[0]
+            await self.adb.add_points_bulk([(game['winner'], XO_PVP_REWARDS['win'])], "فوز في XO ضد صديق")
+            if not resigned:
+                await self.adb.add_points_bulk([(loser, XO_PVP_REWARDS['loss'])], "مشاركة في XO ضد صديق")
+        for player in players:
+            await self.adb.update_game_stats(player, "xo_pvp", won=player == game['winner'])
+    
+    async def expire(self, bot, stale_before):
+        # إبلاغ اللاعبين قبل الحذف، وإلا بقيت اللوحة بأزرار تبدو صالحة
+        expired = []
+        for game_id, version in await self.adb.get_stale_xo_games(stale_before):
+            game = self.active.get(game_id)
+            # حركة وصلت أثناء القراءة تعني أن المباراة لم تعد خاملة
+            if game is not None and game['version'] == version:
+                expired.append(self.active.pop(game_id))
+        edits = [
+            bot.edit_message_text(chat_id=player, message_id=message_id, text="⌛ انتهت المباراة لعدم النشاط")
+            for game in expired
+            for player, message_id in ((game['player_x'], game['x_message_id']), (game['player_o'], game['o_message_id']))
+            if player and message_id
         ]
-        await query.edit_message_text(
-            f"❌⭕ **لعبة XO**\n\nدورك: X\n{format_xo_board(board)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return XO_GAME
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception) and not isinstance(result, BadRequest):
+                logger.warning("⚠️ تعذر إبلاغ لاعب بانتهاء مباراة XO: %s", result)
+    
+    async def sweep(self, bot):
+        # المباريات الخاملة والسجل القديم يُحذفان على دفعات حتى لا يطول قفل الكتابة
+        now = datetime.now()
+        stale_before = (now - timedelta(seconds=XO_MATCH_TTL)).isoformat()
+        finished_before = (now - timedelta(days=XO_HISTORY_DAYS)).isoformat()
+        await self.expire(bot, stale_before)
+        removed = 0
+        while True:
+            batch = await self.adb.sweep_xo_games(stale_before, finished_before, XO_SWEEP_BATCH)
+            for game_id in batch:
+                self.active.pop(game_id, None)
+            removed += len(batch)
+            if len(batch) < XO_SWEEP_BATCH:
+                break
+        if removed:
+            logger.info("🧹 حذف %s مباراة XO قديمة", removed)
+        return removed
+
+xo_matches = XOMatches(adb)
+
+@router.route("game_pvp")
+async def game_pvp(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await xo_matches.create(context.bot, update.callback_query, update.effective_user.id)
+
+@router.route("pvp_*", answer=False)
+async def pvp_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        _, game_id, version, action = query.data.split('_')
+        version = int(version)
+    except ValueError:
+        await query.answer()
+        return
+    alert = await xo_matches.play(context.bot, update.effective_user.id, game_id, version, action)
+    if alert:
+        await query.answer(alert, show_alert=True)
+    else:
+        await query.answer()
 
 # ==================== لعبة التخمين ====================
 
+@timed("message", "guess")
 async def guess_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
@@ -995,8 +3952,8 @@ async def guess_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if guess == secret:
             points = max(30 - attempts * 2, 5)
-            db.add_points(user_id, points, "فوز تخمين")
-            db.update_game_stats(user_id, "guess", won=True, score=points)
+            await adb.add_points(user_id, points, "فوز تخمين")
+            await adb.update_game_stats(user_id, "guess", won=True, score=points)
             await update.message.reply_text(f"🎉 مبروك! الرقم {secret}\n🎁 +{points} نقطة", parse_mode=ParseMode.MARKDOWN)
             return ConversationHandler.END
         elif attempts >= 7:
@@ -1012,48 +3969,78 @@ async def guess_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== إضافة مهمة ====================
 
+@timed("message", "todo_add")
 async def todo_add_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     task = update.message.text
-    todo_id = db.add_todo(user_id, task)
-    db.add_points(user_id, 5, "إضافة مهمة")
+    todo_id = await adb.add_todo(user_id, task)
+    await adb.add_points(user_id, 5, "إضافة مهمة")
     await update.message.reply_text(f"✅ تم إضافة المهمة\n📝 {task}", parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 # ==================== معالج الرسائل ====================
 
+@timed("message", "text")
 async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if db.is_banned(user_id):
+    if await adb.is_banned(user_id):
         return
     
-    db.update_activity(user_id)
+    activity.touch(user_id)
     text = update.message.text
     
     awaiting = context.user_data.get('awaiting')
     if awaiting == 'weather':
-        await update.message.reply_text(f"🌤 طقس {text}:\n25°C - مشمس", parse_mode=ParseMode.MARKDOWN)
+        try:
+            city, report = await weather.report(text)
+            if city is None:
+                suggestions = weather.cities.suggestions(text)
+                hint = f"\nهل تقصد: {'، '.join(suggestions)}؟" if suggestions else ""
+                await update.message.reply_text(f"⚠️ لم أتعرف على المدينة{hint}")
+            else:
+                await update.message.reply_text(WeatherService.format(city, report), parse_mode=ParseMode.MARKDOWN)
+        except:
+            await update.message.reply_text("⚠️ تعذر جلب الطقس حالياً، حاول لاحقاً")
         context.user_data['awaiting'] = None
     elif awaiting == 'currency':
         try:
-            parts = text.split()
-            if len(parts) == 3:
-                amount, from_c, to_c = float(parts[0]), parts[1].upper(), parts[2].upper()
-                rates = {"USD":1, "EUR":0.92, "GBP":0.79, "EGP":30.9, "AED":3.67, "SAR":3.75}
-                if from_c in rates and to_c in rates:
-                    result = amount / rates[from_c] * rates[to_c]
-                    await update.message.reply_text(f"💰 {amount} {from_c} = {result:.2f} {to_c}")
-                    db.add_points(user_id, 2, "تحويل عملات")
-                else:
+            parts = [p for p in text.upper().split() if p not in ('TO', 'إلى', 'الى')]
+            amount, from_c = float(parts[0]), parts[1]
+            to_c = parts[2] if len(parts) > 2 else 'ALL'
+            if to_c in ('ALL', 'الكل'):
+                values, snapshot = currency_rates.convert_all(amount, from_c)
+                if values is None:
                     await update.message.reply_text("⚠️ عملة غير مدعومة")
+                else:
+                    await update.message.reply_text(format_currency_table(amount, from_c, values, snapshot),
+                                                    parse_mode=ParseMode.MARKDOWN)
+                    await adb.add_points(user_id, 2, "تحويل عملات")
             else:
-                await update.message.reply_text("⚠️ الصيغة: قيمة من إلى")
+                result = currency_rates.convert(amount, from_c, to_c)
+                if result is None:
+                    await update.message.reply_text("⚠️ عملة غير مدعومة")
+                else:
+                    await update.message.reply_text(f"💰 {amount:g} {from_c} = {result:,.2f} {to_c}")
+                    await adb.add_points(user_id, 2, "تحويل عملات")
         except:
-            await update.message.reply_text("⚠️ خطأ في الصيغة")
+            await update.message.reply_text("⚠️ الصيغة: قيمة من إلى\nمثال: 100 USD EUR أو 100 USD all")
         context.user_data['awaiting'] = None
     elif awaiting == 'translate':
-        await update.message.reply_text(f"🌍 الترجمة:\n{text}\n\n[نص تجريبي]", parse_mode=ParseMode.MARKDOWN)
-        db.add_points(user_id, 2, "ترجمة")
+        if not translator.available:
+            await update.message.reply_text("🌍 الترجمة غير متاحة حالياً")
+        elif len(text) > TRANSLATE_MAX_CHARS:
+            await update.message.reply_text(f"⚠️ النص طويل، الحد {TRANSLATE_MAX_CHARS} حرف")
+        else:
+            try:
+                translated, src = await translator.translate(text)
+                if src == 'ar':
+                    await update.message.reply_text("🌍 النص بالعربية بالفعل ✅")
+                else:
+                    label = "" if src == 'auto' else f" ({src} ← ar)"
+                    await update.message.reply_text(f"🌍 الترجمة{label}:\n{translated}")
+                    await adb.add_points(user_id, 2, "ترجمة")
+            except:
+                await update.message.reply_text("⚠️ تعذرت الترجمة حالياً، حاول لاحقاً")
         context.user_data['awaiting'] = None
     else:
         text_lower = text.lower()
@@ -1064,33 +4051,37 @@ async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== الأوامر النصية ====================
 
+@timed("command", "id")
 async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     await update.message.reply_text(f"🆔 معرفك: `{user.id}`", parse_mode=ParseMode.MARKDOWN)
 
+@timed("command", "add")
 async def add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("📝 استخدم: /add [المهمة]")
         return
     task = ' '.join(context.args)
-    todo_id = db.add_todo(update.effective_user.id, task)
-    db.add_points(update.effective_user.id, 5, "إضافة مهمة")
+    todo_id = await adb.add_todo(update.effective_user.id, task)
+    await adb.add_points(update.effective_user.id, 5, "إضافة مهمة")
     await update.message.reply_text(f"✅ تم إضافة المهمة: {task}")
 
+@timed("command", "done")
 async def done_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("📝 استخدم: /done [رقم المهمة]")
         return
     try:
         todo_id = int(context.args[0])
-        if db.complete_todo(todo_id, update.effective_user.id):
-            db.add_points(update.effective_user.id, 10, "إكمال مهمة")
+        if await adb.complete_todo(todo_id, update.effective_user.id):
+            await adb.add_points(update.effective_user.id, 10, "إكمال مهمة")
             await update.message.reply_text(f"✅ تم إكمال المهمة {todo_id}")
         else:
             await update.message.reply_text("⚠️ المهمة غير موجودة")
     except:
         await update.message.reply_text("⚠️ رقم غير صحيح")
 
+@timed("command", "remind")
 async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
         await update.message.reply_text("⏰ استخدم: /remind [النص] [الدقائق]")
@@ -1098,26 +4089,20 @@ async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         minutes = int(context.args[-1])
         text = ' '.join(context.args[:-1])
-        reminder_id = db.add_reminder(update.effective_user.id, update.effective_chat.id, text, minutes)
-        db.add_points(update.effective_user.id, 3, "إضافة تذكير")
+        remind_at = datetime.now() + timedelta(minutes=minutes)
+        reminder_id = await adb.add_reminder(update.effective_user.id, update.effective_chat.id, text, minutes)
+        reminders.schedule(reminder_id, remind_at)
+        await adb.add_points(update.effective_user.id, 3, "إضافة تذكير")
         await update.message.reply_text(f"✅ تم ضبط تذكير بعد {minutes} دقيقة:\n{text}")
-        asyncio.create_task(send_reminder(reminder_id, minutes, text, update.effective_chat.id))
     except:
         await update.message.reply_text("⚠️ خطأ في الصيغة")
 
-async def send_reminder(reminder_id, minutes, text, chat_id):
-    await asyncio.sleep(minutes * 60)
-    try:
-        await bot_app.bot.send_message(chat_id=chat_id, text=f"⏰ **تذكير**\n\n{text}", parse_mode=ParseMode.MARKDOWN)
-        db.mark_reminder_sent(reminder_id)
-    except:
-        pass
-
 # ==================== أوامر المشرفين ====================
 
+@timed("command", "addadmin")
 async def admin_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not db.is_admin(user_id):
+    if not await adb.is_admin(user_id):
         await update.message.reply_text("⛔ ليس لديك صلاحية!")
         return
     if len(context.args) < 2:
@@ -1126,14 +4111,15 @@ async def admin_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target = int(context.args[0])
         level = context.args[1]
-        db.add_admin(target, None, level, user_id)
+        await adb.add_admin(target, None, level, user_id)
         await update.message.reply_text(f"✅ تمت إضافة المشرف {target}")
     except:
         await update.message.reply_text("⚠️ خطأ")
 
+@timed("command", "ban")
 async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not db.is_admin(user_id):
+    if not await adb.is_admin(user_id):
         await update.message.reply_text("⛔ ليس لديك صلاحية!")
         return
     if len(context.args) < 2:
@@ -1142,14 +4128,15 @@ async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target = int(context.args[0])
         reason = ' '.join(context.args[1:])
-        db.ban_user(target, user_id, reason)
+        await adb.ban_user(target, user_id, reason)
         await update.message.reply_text(f"✅ تم حظر {target}")
     except:
         await update.message.reply_text("⚠️ خطأ")
 
+@timed("command", "unban")
 async def admin_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not db.is_admin(user_id):
+    if not await adb.is_admin(user_id):
         await update.message.reply_text("⛔ ليس لديك صلاحية!")
         return
     if not context.args:
@@ -1157,14 +4144,15 @@ async def admin_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         target = int(context.args[0])
-        db.unban_user(target)
+        await adb.unban_user(target)
         await update.message.reply_text(f"✅ تم إلغاء حظر {target}")
     except:
         await update.message.reply_text("⚠️ خطأ")
 
+@timed("command", "warn")
 async def admin_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not db.is_admin(user_id):
+    if not await adb.is_admin(user_id):
         await update.message.reply_text("⛔ ليس لديك صلاحية!")
         return
     if len(context.args) < 2:
@@ -1173,33 +4161,105 @@ async def admin_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target = int(context.args[0])
         reason = ' '.join(context.args[1:])
-        count = db.warn_user(target, user_id, reason)
+        count = await adb.warn_user(target, user_id, reason)
         await update.message.reply_text(f"⚠️ تم تحذير {target} (تحذير {count})")
         if count >= 3:
-            db.ban_user(target, user_id, "تجاوز 3 تحذيرات", 7)
+            await adb.ban_user(target, user_id, "تجاوز 3 تحذيرات", 7)
             await update.message.reply_text(f"🚫 تم حظر {target} 7 أيام")
     except:
         await update.message.reply_text("⚠️ خطأ")
 
+@timed("command", "addpoints")
 async def admin_add_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not db.is_admin(user_id):
+    if not await adb.is_admin(user_id):
         await update.message.reply_text("⛔ ليس لديك صلاحية!")
         return
     if len(context.args) < 3:
-        await update.message.reply_text("⭐ استخدم: /addpoints [المعرف] [النقاط] [السبب]")
+        await update.message.reply_text("⭐ استخدم: /addpoints [المعرف,المعرف...] [النقاط] [السبب]")
         return
     try:
-        target = int(context.args[0])
+        targets = [int(t) for t in context.args[0].split(',') if t]
         points = int(context.args[1])
         reason = ' '.join(context.args[2:])
-        db.add_points(target, points, f"مكافأة مشرف: {reason}")
-        await update.message.reply_text(f"✅ تم إضافة {points} نقطة لـ {target}")
+        credited = await adb.add_points_bulk([(t, points) for t in targets], f"مكافأة مشرف: {reason}")
+        await update.message.reply_text(f"✅ تم إضافة {points} نقطة لـ {len(credited)} مستخدم")
     except:
         await update.message.reply_text("⚠️ خطأ")
 
+@timed("command", "addword")
+async def admin_add_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not await adb.is_admin(user_id):
+        await update.message.reply_text("⛔ ليس لديك صلاحية!")
+        return
+    if not context.args:
+        await update.message.reply_text("🔤 استخدم: /addword [الكلمة]")
+        return
+    word = ' '.join(context.args)
+    if await adb.add_banned_word(word, user_id):
+        word_filter.reload(await adb.get_banned_words())
+        await update.message.reply_text(f"✅ تمت إضافة الكلمة ({len(word_filter)} كلمة)")
+    else:
+        await update.message.reply_text("⚠️ الكلمة موجودة مسبقاً")
+
+@timed("command", "broadcast")
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not await adb.is_admin(user_id):
+        await update.message.reply_text("⛔ ليس لديك صلاحية!")
+        return
+    if not context.args:
+        await update.message.reply_text("📢 استخدم: /broadcast [الرسالة]")
+        return
+    if broadcasts.is_running():
+        await update.message.reply_text("⏳ يوجد بث جارٍ بالفعل")
+        return
+    text = update.message.text.split(None, 1)[1]
+    await broadcasts.start(context.bot, user_id, update.effective_chat.id, text)
+
 # ==================== تشغيل البوت ====================
 
+async def run_periodically(interval, func):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception:
+            logger.exception("❌ خطأ في مهمة دورية %s", getattr(func, '__name__', func))
+
+background_tasks = []
+metrics_runners = []
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # مستخدمون مختلفون بالتوازي، وتحديثات المستخدم الواحد بالترتيب كما تفترض ConversationHandler وuser_data
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+    
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await coroutine
+            return
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
 async def post_init(app: Application):
     commands = [
         BotCommand("start", "بدء البوت"),
@@ -1209,13 +4269,148 @@ async def post_init(app: Application):
         BotCommand("remind", "تذكير"),
     ]
     await app.bot.set_my_commands(commands)
+    activity.start()
+    reminders.start(app.bot)
+    await broadcasts.resume(app.bot)
+    await xo_matches.load()
+    currency_rates.revalidate()
+    background_tasks.append(asyncio.create_task(run_periodically(XO_SWEEP_INTERVAL, partial(xo_matches.sweep, app.bot))))
+    background_tasks.append(asyncio.create_task(run_periodically(LEDGER_FLUSH_INTERVAL, adb.flush_ledger)))
+    if METRICS_PORT and not WEBHOOK_URL:
+        metrics_runners.append(await start_metrics_server(app))
+
+async def post_stop(app: Application):
+    # إيقاف كل ما يرسل رسائل قبل إغلاق البوت وقائمة الإرسال
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await broadcasts.stop()
+    await reminders.stop()
+
+async def post_shutdown(app: Application):
+    await activity.stop()
+    await adb.flush_ledger()
+    await http.close()
+    for runner in metrics_runners:
+        await runner.cleanup()
+    metrics_runners.clear()
+
+# ==================== نقطة المقاييس ====================
+
+async def collect_runtime_metrics(app: Application):
+    # المقاييس المشتقة من الحالة تُقرأ عند الطلب فقط
+    UPDATE_QUEUE.set(app.update_queue.qsize())
+    OUTBOUND_QUEUE.set(outbound.depth())
+    REMINDERS_SCHEDULED.set(len(reminders))
+    stats = await adb.get_stats()
+    REMINDERS_PENDING.set(stats['pending_reminders'])
+    rows = await adb.count_conversations()
+    CONVERSATIONS.clear()
+    for name, count in rows:
+        CONVERSATIONS.labels(name).set(count)
+
+def metrics_view(app: Application):
+    async def serve_metrics(request):
+        if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return web.Response(status=401)
+        await collect_runtime_metrics(app)
+        return web.Response(
+            body=metrics.render().encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        )
+    
+    return serve_metrics
+
+async def start_metrics_server(app: Application):
+    # في وضع polling لا يوجد خادم HTTP، فنشغل خادماً صغيراً للمقاييس فقط
+    server = web.Application()
+    server.router.add_get('/metrics', metrics_view(app))
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_LISTEN, METRICS_PORT).start()
+    logger.info("📈 المقاييس على %s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    return runner
+
+# ==================== وضع Webhook ====================
+
+def build_webhook_server(app: Application):
+    async def receive_update(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, app.bot)
+        except Exception:
+            # 400 بدل 500 حتى لا يعيد Telegram إرسال نفس الجسم المعطوب مراراً
+            logger.warning("⚠️ تحديث Webhook غير صالح", exc_info=True)
+            return web.Response(status=400)
+        await app.update_queue.put(update)
+        return web.Response()
+    
+    async def health(request):
+        return web.json_response({
+            'status': 'ok' if app.running else 'starting',
+            'update_queue': app.update_queue.qsize(),
+            'outbound_queue': outbound.depth(),
+        })
+    
+    server = web.Application()
+    server.router.add_post(WEBHOOK_PATH, receive_update)
+    server.router.add_get('/health', health)
+    server.router.add_get('/metrics', metrics_view(app))
+    return server
+
+async def serve_webhook(app: Application):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    runner = web.AppRunner(build_webhook_server(app))
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=min(max(CONCURRENT_UPDATES, 40), 100),
+        )
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, PORT).start()
+        await app.start()
+        logger.info("🌐 Webhook يعمل على %s:%s%s", WEBHOOK_LISTEN, PORT, WEBHOOK_PATH)
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if app.running:
+            await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
 
 def main():
     global bot_app
     logger.info("🚀 تشغيل البوت...")
-    bot_app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    bot_app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(outbound)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app = bot_app
     
+    app.add_handler(TypeHandler(Update, flood_guard), group=-2)
+    app.add_handler(MessageHandler(filters.TEXT, word_guard), group=-1)
+    
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("id", id_command))
     app.add_handler(CommandHandler("add", add_command))
@@ -1227,30 +4422,46 @@ def main():
     app.add_handler(CommandHandler("unban", admin_unban))
     app.add_handler(CommandHandler("warn", admin_warn))
     app.add_handler(CommandHandler("addpoints", admin_add_points))
+    app.add_handler(CommandHandler("broadcast", admin_broadcast))
+    app.add_handler(CommandHandler("addword", admin_add_word))
     
     app.add_handler(ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^game_guess$")],
+        entry_points=[CallbackQueryHandler(router.handler("game_guess"), pattern="^game_guess$")],
         states={GUESS_GAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, guess_received)]},
-        fallbacks=[]
+        fallbacks=[],
+        name="guess_game",
+        persistent=True
     ))
     
     app.add_handler(ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^game_xo$")],
-        states={XO_GAME: [CallbackQueryHandler(xo_handler)]},
-        fallbacks=[]
+        entry_points=[CallbackQueryHandler(router.handler("game_xo"), pattern="^game_xo$")],
+        states={XO_GAME: [CallbackQueryHandler(router.handler("xo_*"), pattern="^xo_")]},
+        fallbacks=[],
+        name="xo_game",
+        persistent=True
     ))
     
     app.add_handler(ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^todo_add$")],
+        entry_points=[CallbackQueryHandler(router.handler("todo_add"), pattern="^todo_add$")],
         states={TODO_ADD: [MessageHandler(filters.TEXT & ~filters.COMMAND, todo_add_received)]},
-        fallbacks=[]
+        fallbacks=[],
+        name="todo_add",
+        persistent=True
     ))
     
-    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_handler(CallbackQueryHandler(router.dispatch))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_messages))
     
     logger.info("✅ البوت شغال!")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if WEBHOOK_URL:
+            asyncio.run(serve_webhook(app))
+        else:
+            app.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        translator.close()
+        adb.shutdown()
+        db.close()
 
 if __name__ == '__main__':
     main()